@@ -0,0 +1,49 @@
+"""
+Runs a GPT exported by export.py. Only needs torch, sampling.py and the export directory: model.py, train.py
+and the ckpt.pt are not involved, and no module has to be rebuilt or compiled at load time.
+
+>>> model = AOTModel('out-cybersecurity-enhanced/export')
+>>> tokens = model.generate(prompt_ids, 150, temperature=0.7, top_k=50)
+"""
+
+import os
+import json
+
+import torch
+
+import sampling
+
+class AOTModel:
+
+    def __init__(self, export_dir):
+        with open(os.path.join(export_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.block_size = meta['block_size']
+        if meta['aoti']:
+            load = lambda path: torch._inductor.aoti_load_package(path)
+        else:
+            load = lambda path: torch.export.load(path).module()
+        self.prefill = load(os.path.join(export_dir, 'prefill.pt2'))
+        self.decode = load(os.path.join(export_dir, 'decode.pt2'))
+
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, stop=None, top_p=None, min_p=None, context_stride=1):
+        """ complete the list of token indices idx, returns the list of generated token indices """
+        seq = list(idx)
+        out = []
+        pos = None # position of the next token to decode, the KV cache holds everything before it
+        for _ in range(max_new_tokens):
+            if pos is not None and pos < self.block_size:
+                logits, kv = self.decode(torch.tensor([[seq[-1]]]), torch.tensor([pos]), kv)
+                pos += 1
+            else:
+                # (re)fill the cache from the last tokens, like GPT.generate (also for context_stride)
+                window = seq if len(seq) <= self.block_size else seq[-(self.block_size - context_stride + 1):]
+                logits, kv = self.prefill(torch.tensor([window]))
+                pos = len(window)
+            tok = sampling.sample(logits, temperature, top_k, top_p, min_p).item()
+            seq.append(tok)
+            out.append(tok)
+            if stop is not None and (stop.matches(out) if hasattr(stop, 'matches') else any(0 < len(s) <= len(out) and out[-len(s):] == list(s) for s in stop)):
+                break
+        return out
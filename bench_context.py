@@ -0,0 +1,65 @@
+"""
+Cost/quality trade-off of generating past block_size with GPT.generate(context_stride=...).
+
+For every stride this measures
+- tokens/s of a long generation, most of it past block_size
+- the validation loss when every token only sees the context it would get during such a
+  generation: windows of block_size tokens that advance by stride, scoring their last stride
+  positions. stride 1 is the exact sliding window, every token sees block_size tokens.
+
+$ python bench_context.py --out_dir=out-cybersecurity-enhanced --strides=1,8,32,128
+"""
+import os
+import time
+import math
+import numpy as np
+import torch
+from torch.nn import functional as F
+from model import GPTConfig, GPT
+
+# -----------------------------------------------------------------------------
+out_dir = 'out'
+dataset = 'processed_data' # val.bin of this dataset is scored
+strides = (1, 8, 32, 128) # context_stride values to compare, e.g. --strides=1,16
+eval_tokens = 4096 # number of val tokens scored per stride
+max_new_tokens = 1000 # tokens generated for the tokens/s measurement
+device = 'cpu'
+seed = 1337
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+checkpoint = torch.load(os.path.join(out_dir, 'ckpt.pt'), map_location=device)
+model = GPT.meta(GPTConfig(**checkpoint['model_args'])).assign_state_dict(checkpoint['model'])
+model.eval()
+model.to(device)
+block_size = model.config.block_size
+
+data = np.memmap(os.path.join('data', dataset, 'val.bin'), dtype=np.uint16, mode='r')
+tokens = torch.from_numpy(data[:2 * block_size + eval_tokens].astype(np.int64)).to(device)
+eval_tokens = min(eval_tokens, len(tokens) - 2 * block_size)
+
+@torch.no_grad()
+def strided_loss(stride):
+    """ mean loss of tokens[block_size:block_size+eval_tokens], each seeing the context generate() gives it """
+    nll, n = 0.0, 0
+    for end in range(block_size, block_size + eval_tokens, stride):
+        # the cropped window of the refill plus the stride - 1 tokens decoded on top of it
+        start = end - (block_size - stride + 1)
+        x = tokens[start:start + block_size][None]
+        y = tokens[start + 1:start + block_size + 1][None]
+        logits, _ = model(x, num_logits=stride)
+        nll += F.cross_entropy(logits[0], y[0, -stride:], reduction='sum').item()
+        n += stride
+    return nll / n
+
+prompt = tokens[None, :16]
+print(f"block_size {block_size}, generating {max_new_tokens} tokens from a {prompt.size(1)} token prompt")
+for stride in strides:
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        t0 = time.time()
+        model.generate(prompt, max_new_tokens, context_stride=stride)
+        dt = time.time() - t0
+    loss = strided_loss(stride)
+    print(f"context_stride {stride:4d}: {max_new_tokens/dt:8.1f} tokens/s, val loss {loss:.4f} (ppl {math.exp(loss):.2f}), "
+          f"context {block_size - stride + 1}-{block_size} tokens")
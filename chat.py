@@ -0,0 +1,44 @@
+"""
+Helpers shared by the chat scripts in tests/: the <Q>...</Q> <A>...</A> prompt format and
+streaming an answer to the terminal.
+"""
+
+import torch
+
+from tokenizer import IncrementalDetokenizer
+
+def format_prompt(text):
+    """ the prompt that makes the model answer text: a bare question is wrapped in <Q></Q>, and the prompt always ends with <A> """
+    text = text.strip()
+    if not text.startswith('<Q>'):
+        text = f"<Q>{text}</Q>"
+    if not text.endswith('<A>'):
+        text += "\n<A>"
+    return text
+
+def stream_response(model, encoder, device, prompt, max_new_tokens=150, temperature=0.7):
+    """Print the answer while it is being generated, return the full answer"""
+    
+    # Encode prompt, the answer starts right after its <A>
+    start_ids = encoder.encode(format_prompt(prompt), allowed_special={"<|endoftext|>"})
+    x = torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...]
+    
+    # Decode and print every token as soon as it is sampled
+    detokenizer = IncrementalDetokenizer(encoder)
+    answer, printed = '', 0
+    for token in model.stream(x, max_new_tokens, temperature=temperature, top_k=50):
+        answer += detokenizer.add(token)
+        if '</A>' in answer:
+            # End of the answer, no need to generate any further
+            answer = answer.split('</A>')[0]
+            break
+        # Hold back the last few characters, they could be the start of '</A>'
+        text = answer.lstrip()
+        print(text[printed:len(text) - 3], end="", flush=True)
+        printed = max(printed, len(text) - 3)
+    else:
+        answer += detokenizer.flush()
+    
+    text = answer.strip()
+    print(text[printed:], flush=True)
+    return text
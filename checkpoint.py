@@ -0,0 +1,220 @@
+"""
+Slim inference checkpoints: only the weights, in a flat layout that is memory-mapped on load.
+
+ckpt.pt from train.py also holds the AdamW state (twice the size of the weights) and needs a
+full unpickle into freshly allocated tensors. The slim file is
+- 8 bytes: little-endian length of the header
+- a JSON header: model_args, the training config, the quantization (if any), the fingerprint of
+  the ckpt.pt it was exported from, and the dtype, shape and offset of every tensor. Tied
+  tensors (wte / lm_head) are stored once.
+- the raw tensor data, every tensor aligned to 64 bytes
+load_slim maps the file and the model's parameters become views into the mapping, so nothing
+is copied or unpickled: loading costs the page-ins of the weights that are actually touched,
+and processes that load the same file share the pages through the OS page cache.
+
+$ python checkpoint.py --out_dir=out-cybersecurity-enhanced # writes ckpt_slim.bin next to ckpt.pt
+
+CheckpointManager writes the training checkpoints of train.py without stopping training for the
+serialization: the state is snapshotted to CPU memory, written on a background thread to a
+temporary file and published with an atomic rename, so a crash mid-write leaves the previous
+checkpoint intact. out_dir keeps
+- ckpt.pt: the last checkpoint (what resuming and the inference scripts read)
+- ckpt_best.pt: the one with the lowest val loss
+- recent/ckpt_<iter>.pt: the keep_recent most recent ones
+The three names are hard links to the same file where the filesystem allows it.
+"""
+
+import os
+import json
+import mmap
+import time
+import shutil
+import struct
+import threading
+
+import torch
+
+from model import GPTConfig, GPT
+from quantize import quantize_model
+
+ALIGNMENT = 64
+
+def fingerprint(path):
+    """ size and modification time of a file, to tell whether a checkpoint derived from it is stale """
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def save_slim(model, model_args, path, config=None, quantization=None, source=None):
+    """
+    write the parameters and buffers of model (a GPT, possibly quantized) as a slim checkpoint,
+    source is the fingerprint() of the checkpoint it was exported from
+    """
+    tensors, aliases, seen = {}, {}, {}
+    for name, t in model.state_dict().items():
+        if name.endswith('.attn.bias'):
+            continue # the constant causal mask of the non-flash attention, rebuilt by GPT()
+        key = (t.data_ptr(), t.dtype, tuple(t.shape))
+        if key in seen:
+            aliases[name] = seen[key]
+        else:
+            seen[key] = name
+            tensors[name] = t.detach().cpu().contiguous()
+    header = {'model_args': model_args, 'config': config or {}, 'quantization': quantization, 'source': source, 'aliases': aliases, 'tensors': {}}
+    offset = 0
+    for name, t in tensors.items():
+        nbytes = t.numel() * t.element_size()
+        header['tensors'][name] = {'dtype': str(t.dtype).removeprefix('torch.'), 'shape': list(t.shape), 'offset': offset}
+        offset += -(-nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (-(8 + len(header)) % ALIGNMENT) # the data starts aligned as well
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for t in tensors.values():
+            data = t.reshape(-1).view(torch.uint8).numpy().tobytes()
+            f.write(data)
+            f.write(b'\0' * (-len(data) % ALIGNMENT))
+
+def load_slim(path, device='cpu'):
+    """ load a checkpoint written by save_slim, returns the model and the header dict """
+    with open(path, 'rb') as f:
+        n = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(n))
+        # copy-on-write mapping: pages are shared with the page cache until someone writes to them
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    start = 8 + n
+    state_dict = {}
+    for name, meta in header['tensors'].items():
+        dtype = getattr(torch, meta['dtype'])
+        count = 1
+        for d in meta['shape']:
+            count *= d
+        t = torch.frombuffer(buf, dtype=dtype, count=count, offset=start + meta['offset']) if count else torch.empty(0, dtype=dtype)
+        state_dict[name] = t.view(meta['shape'])
+    for name, target in header['aliases'].items():
+        state_dict[name] = state_dict[target]
+    model = GPT.meta(GPTConfig(**header['model_args']))
+    if header['quantization']:
+        quantize_model(model, header['quantization'])
+    # the parameters become the mapped tensors instead of being copied into
+    model.assign_state_dict(state_dict)
+    return model.to(device), header
+
+def snapshot(obj, into=None, memo=None):
+    """
+    copy of a (nested dict / list of) state with every tensor copied to CPU memory. The tensors of
+    into, an earlier snapshot of the same structure, are reused as destination where they match.
+    A tensor that appears twice (tied wte / lm_head) is copied once and stays shared
+    """
+    memo = {} if memo is None else memo
+    if isinstance(obj, torch.Tensor):
+        key = (obj.data_ptr(), obj.dtype, tuple(obj.shape), obj.stride()) if obj.numel() else id(obj)
+        if key not in memo:
+            if isinstance(into, torch.Tensor) and into.shape == obj.shape and into.dtype == obj.dtype:
+                memo[key] = into.copy_(obj.detach())
+            else:
+                memo[key] = obj.detach().to('cpu', copy=True)
+        return memo[key]
+    if isinstance(obj, dict):
+        into = into if isinstance(into, dict) else {}
+        return {k: snapshot(v, into.get(k), memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        into = into if isinstance(into, (list, tuple)) and len(into) == len(obj) else [None] * len(obj)
+        return type(obj)(snapshot(v, w, memo) for v, w in zip(obj, into))
+    return obj
+
+class CheckpointManager:
+
+    def __init__(self, out_dir, keep_recent=3):
+        self.out_dir = out_dir
+        self.keep_recent = keep_recent # number of recent/ckpt_<iter>.pt kept, 0 = none
+        self.thread = None
+        self.error = None
+        self.state = None # the last snapshot, its buffers are reused by the next one
+        # metrics of the last save
+        self.block_time = 0.0 # seconds the training loop was stopped: waiting for the previous write, snapshot
+        self.write_time = 0.0 # seconds the background write took
+
+    def save(self, checkpoint, iter_num, is_best=False):
+        """
+        snapshot checkpoint (a dict of state) and write it in the background. Returns the seconds it
+        blocked and the seconds the previous write took (0 for the first save), which is only known
+        once save has waited for it
+        """
+        t0 = time.time()
+        self.wait() # at most one write in flight, so the previous snapshot's memory is free to reuse
+        previous_write_time = self.write_time
+        self.state = snapshot(checkpoint, self.state)
+        self.thread = threading.Thread(target=self._write, args=(self.state, iter_num, is_best))
+        self.thread.start()
+        self.block_time = time.time() - t0
+        return self.block_time, previous_write_time
+
+    def wait(self):
+        """ block until the pending write is published, re-raise its error if it failed """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _write(self, state, iter_num, is_best):
+        try:
+            t0 = time.time()
+            tmp = os.path.join(self.out_dir, f'.ckpt_{iter_num}.pt.tmp')
+            with open(tmp, 'wb') as f:
+                torch.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            if self.keep_recent > 0:
+                recent_dir = os.path.join(self.out_dir, 'recent')
+                os.makedirs(recent_dir, exist_ok=True)
+                self._publish(tmp, os.path.join(recent_dir, f'ckpt_{iter_num:07d}.pt'))
+                for name in sorted(os.listdir(recent_dir))[:-self.keep_recent]:
+                    os.remove(os.path.join(recent_dir, name))
+            if is_best:
+                self._publish(tmp, os.path.join(self.out_dir, 'ckpt_best.pt'))
+            os.replace(tmp, os.path.join(self.out_dir, 'ckpt.pt'))
+            self.write_time = time.time() - t0
+        except BaseException as e:
+            self.error = e # raised in the training loop by the next save() or wait()
+
+    @staticmethod
+    def _publish(tmp, path):
+        # another name for the finished file: a hard link (no copy) renamed over path atomically
+        link = path + '.tmp'
+        if os.path.exists(link):
+            os.remove(link)
+        try:
+            os.link(tmp, link)
+        except OSError:
+            shutil.copyfile(tmp, link) # no hard links on this filesystem
+        os.replace(link, path)
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    out_dir = 'out'
+    dtype = '' # '' keeps the checkpoint's dtype, 'bfloat16' / 'float16' halve the file
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -------------------------------------------------------------------------
+    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
+    def load_ckpt():
+        checkpoint = torch.load(ckpt_path, map_location='cpu')
+        model = GPT.meta(GPTConfig(**checkpoint['model_args'])).assign_state_dict(checkpoint['model'])
+        return model, checkpoint
+    model, checkpoint = load_ckpt()
+    if dtype:
+        model.to(getattr(torch, dtype))
+    slim_path = os.path.join(out_dir, 'ckpt_slim.bin')
+    save_slim(model, checkpoint['model_args'], slim_path, checkpoint.get('config'), source=fingerprint(ckpt_path))
+    print(f"wrote {slim_path}: {os.path.getsize(slim_path)/1e6:.1f} MB (ckpt.pt: {os.path.getsize(ckpt_path)/1e6:.1f} MB)")
+    del checkpoint, model
+
+    # time to a usable model, both ways
+    t0 = time.time()
+    load_ckpt()
+    t1 = time.time()
+    load_slim(slim_path)
+    t2 = time.time()
+    print(f"load time: ckpt.pt {(t1 - t0)*1000:.1f}ms, ckpt_slim.bin {(t2 - t1)*1000:.1f}ms")
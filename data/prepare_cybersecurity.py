@@ -7,6 +7,7 @@ Converts scraped data into the format needed by nanoGPT
 import os
 import json
 import pickle
+import argparse
 import numpy as np
 from typing import List, Dict
 import tiktoken
@@ -16,9 +17,10 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class CybersecurityDataPrep:
-    def __init__(self, data_dir="data/raw_data", output_dir="data/processed_data"):
+    def __init__(self, data_dir="data/raw_data", output_dir="data/processed_data", compact_vocab=False):
         self.data_dir = data_dir
         self.output_dir = output_dir
+        self.compact_vocab = compact_vocab
         self.encoder = tiktoken.get_encoding("gpt2")
         
         # Create output directory
@@ -159,6 +161,11 @@ class CybersecurityDataPrep:
         
         return prompts
     
+    def build_compact_vocab(self, encoded: List[int]) -> List[int]:
+        """GPT-2 ids of the compact vocabulary: every id in the corpus, the 256 byte tokens and <|endoftext|>"""
+        byte_tokens = [self.encoder.encode_single_token(bytes([b])) for b in range(256)]
+        return sorted(set(encoded) | set(byte_tokens) | {self.encoder.eot_token})
+    
     def prepare_training_data(self):
         """Prepare data for GPT training"""
         logger.info("Loading scraped data...")
@@ -186,14 +193,29 @@ class CybersecurityDataPrep:
         logger.info(f"Total conversations: {len(all_text)}")
         logger.info(f"Total characters: {len(full_text)}")
         
-        # Encode the text
+        # Encode the text, one document (Q&A pair and its trailing newline) at a time to know where each one starts
         logger.info("Encoding text...")
-        encoded = self.encoder.encode(full_text)
+        newline = self.encoder.encode('\n')
+        encoded, doc_starts = [], []
+        for i, text in enumerate(all_text):
+            doc_starts.append(len(encoded))
+            encoded.extend(self.encoder.encode(text) + (newline if i < len(all_text) - 1 else []))
         
         logger.info(f"Total tokens: {len(encoded)}")
         
-        # Split into train/validation (90/10 split)
-        split_idx = int(0.9 * len(encoded))
+        vocab_remap = None
+        if self.compact_vocab:
+            # train on compact ids, tokenizer.load_encoding translates back to GPT-2 ids with the remap
+            vocab_remap = self.build_compact_vocab(encoded)
+            lookup = np.full(self.encoder.n_vocab, -1, dtype=np.int64)
+            lookup[vocab_remap] = np.arange(len(vocab_remap))
+            encoded = lookup[np.array(encoded, dtype=np.int64)].tolist()
+            logger.info(f"Compact vocabulary: {len(vocab_remap)} of {self.encoder.n_vocab} tokens")
+        
+        # Split into train/validation (90/10 split), on the first document boundary past 90%
+        doc_starts = np.array(doc_starts + [len(encoded)], dtype=np.int64)
+        split_doc = min(int(np.searchsorted(doc_starts, int(0.9 * len(encoded)))), len(all_text) - 1)
+        split_idx = int(doc_starts[split_doc])
         train_data = encoded[:split_idx]
         val_data = encoded[split_idx:]
         
@@ -204,14 +226,23 @@ class CybersecurityDataPrep:
         np.array(train_data, dtype=np.uint16).tofile(train_file)
         np.array(val_data, dtype=np.uint16).tofile(val_file)
         
+        # Document index of each split: offsets of the document starts plus the end of the split,
+        # document i is tokens [offsets[i], offsets[i+1]). Used by train.py's packed loader
+        doc_starts[:split_doc + 1].astype(np.uint32).tofile(os.path.join(self.output_dir, 'train_docs.bin'))
+        (doc_starts[split_doc:] - split_idx).astype(np.uint32).tofile(os.path.join(self.output_dir, 'val_docs.bin'))
+        
         # Save metadata
         meta = {
-            'vocab_size': self.encoder.n_vocab,
+            'vocab_size': len(vocab_remap) if vocab_remap is not None else self.encoder.n_vocab,
             'special_tokens': self.special_tokens,
             'train_tokens': len(train_data),
             'val_tokens': len(val_data),
-            'total_tokens': len(encoded)
+            'total_tokens': len(encoded),
+            'train_docs': split_doc,
+            'val_docs': len(all_text) - split_doc
         }
+        if vocab_remap is not None:
+            meta['vocab_remap'] = vocab_remap # GPT-2 token id of every compact id
         
         meta_file = os.path.join(self.output_dir, 'meta.pkl')
         with open(meta_file, 'wb') as f:
@@ -227,7 +258,11 @@ class CybersecurityDataPrep:
         logger.info(f"Validation tokens: {len(val_data)}")
 
 def main():
-    prep = CybersecurityDataPrep()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--compact-vocab', action='store_true',
+                        help='train on the token ids used by the corpus only, with a remap table in meta.pkl')
+    args = parser.parse_args()
+    prep = CybersecurityDataPrep(compact_vocab=args.compact_vocab)
     prep.prepare_training_data()
 
 if __name__ == "__main__":
@@ -0,0 +1,232 @@
+"""
+Background prefetching data loader for train.py.
+
+A worker thread samples random block_size windows of a split (train.bin / val.bin) into a bounded
+ring of depth preallocated buffers, pinned when training on CUDA, while the training loop runs the
+model. A batch is gathered in one vectorized read of its block_size + 1 token windows from the
+memmap, and X and Y are views of the same window (Y is X shifted by one token). next() hands
+out the oldest ready batch and gives its buffer back to the worker, so batch assembly is off the
+critical path unless the loader falls behind. The time the loop spends waiting for a batch
+(stall) and the number of batches that were ready when it asked (queue depth) are collected for
+the log, see stats().
+
+With packed=True the windows do not start at random offsets but are filled with whole documents
+(Q&A pairs) drawn at random, using the <split>_docs.bin index written by data prep. A window takes
+documents until the next one drawn does not fit, the rest of it is padding with target -1 (which
+the loss ignores) and a document id of its own, so no Q&A pair is cut off at the end of a window.
+Only a document longer than a whole window is sliced, to a random window of it. Such batches come
+with the document id of every position, for GPT.forward to keep attention within each document.
+"""
+
+import os
+import time
+import queue
+import threading
+
+import numpy as np
+import torch
+
+class PrefetchLoader:
+
+    def __init__(self, data_dir, split, batch_size, block_size, device='cpu', depth=4, seed=1337, remap_every=1000, packed=False):
+        self.path = os.path.join(data_dir, f'{split}.bin')
+        self.packed = packed
+        if packed:
+            docs_path = os.path.join(data_dir, f'{split}_docs.bin')
+            assert os.path.exists(docs_path), f"{docs_path} not found, rerun data prep to index the documents"
+            self.offsets = np.fromfile(docs_path, dtype=np.uint32).astype(np.int64) # document i is tokens [offsets[i], offsets[i+1])
+            self.rng = np.random.default_rng(seed)
+        self.remap_every = remap_every # batches between reopening the memmap, see _fill
+        self.data = None
+        self.filled = 0
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.device = device
+        self.depth = depth # batches prepared ahead, 0 = load synchronously in next()
+        self.cuda = 'cuda' in str(device)
+        self.generator = torch.Generator().manual_seed(seed) # own generator, the worker must not race the training RNG
+        # the ring of (batch_size, block_size + 1) window buffers, pinned so the copy to the GPU can be asynchronous
+        self.buffers = [torch.empty(batch_size, block_size + 1, dtype=torch.int64, pin_memory=self.cuda) for _ in range(max(depth, 1))]
+        self.doc_buffers = [torch.empty_like(buf) for buf in self.buffers] if packed else None # document id of every position
+        self.copied = [None] * len(self.buffers) # per buffer, the CUDA event of its last copy to the device
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for slot in range(len(self.buffers)):
+            self.free.put(slot)
+        self.stopped = False
+        # metrics since the last stats(reset=True)
+        self.batches = 0
+        self.stall_time = 0.0
+        self.depth_sum = 0
+        if depth > 0:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def next(self):
+        """ the next (X, Y, doc_ids) batch on device, doc_ids is None unless packed """
+        t0 = time.time()
+        self.depth_sum += self.ready.qsize()
+        if self.depth > 0:
+            slot = self.ready.get()
+            if isinstance(slot, BaseException):
+                raise slot
+        else:
+            slot = self.free.get()
+            self._fill(slot)
+        self.stall_time += time.time() - t0
+        self.batches += 1
+        # the buffer is refilled while the model still holds on to the batch (backward), so copy it
+        windows = self.buffers[slot].to(self.device, non_blocking=self.cuda, copy=True)
+        docs = self.doc_buffers[slot].to(self.device, non_blocking=self.cuda, copy=True)[:, :-1] if self.packed else None
+        if self.cuda:
+            # the worker may only refill the buffer once this copy is done
+            self.copied[slot] = torch.cuda.Event()
+            self.copied[slot].record()
+        self.free.put(slot)
+        if self.packed:
+            # padding is fed as token 0, it comes after the real tokens and is never attended to
+            return windows[:, :-1].clamp(min=0), windows[:, 1:], docs
+        return windows[:, :-1], windows[:, 1:], docs
+
+    def stats(self, reset=True):
+        """ batches handed out, total stall time (s) and mean queue depth since the last reset """
+        out = dict(batches=self.batches, stall=self.stall_time, depth=self.depth_sum / max(self.batches, 1))
+        if reset:
+            self.batches, self.stall_time, self.depth_sum = 0, 0.0, 0
+        return out
+
+    def close(self):
+        self.stopped = True
+        self.free.put(None) # wake the worker up
+
+    def _run(self):
+        try:
+            while True:
+                slot = self.free.get()
+                if self.stopped or slot is None:
+                    return
+                if self.copied[slot] is not None:
+                    self.copied[slot].synchronize()
+                self._fill(slot)
+                self.ready.put(slot)
+        except BaseException as e:
+            self.ready.put(e) # re-raised by next() in the training loop
+
+    def _fill(self, slot):
+        # a memmap that stays open keeps every page it touched accounted to the process, see
+        # https://stackoverflow.com/questions/45132940/numpy-memmap-memory-usage-want-to-iterate-once/61472122#61472122
+        # so it is reopened every remap_every batches instead of every batch
+        if self.data is None or self.filled % self.remap_every == 0:
+            self.data = np.memmap(self.path, dtype=np.uint16, mode='r')
+            self.windows = np.lib.stride_tricks.sliding_window_view(self.data, self.block_size + 1)
+        self.filled += 1
+        if self.packed:
+            self._fill_packed(self.buffers[slot].numpy(), self.doc_buffers[slot].numpy())
+            return
+        ix = torch.randint(len(self.data) - self.block_size, (self.batch_size,), generator=self.generator)
+        # one fancy-index gather of all the windows, widened to int64 straight into the buffer
+        np.copyto(self.buffers[slot].numpy(), self.windows[ix.numpy()])
+
+    def _fill_packed(self, buf, docs):
+        n = self.block_size + 1
+        for row in range(self.batch_size):
+            pos, doc = 0, 0
+            while pos < n:
+                d = int(self.rng.integers(len(self.offsets) - 1))
+                start, end = self.offsets[d], self.offsets[d + 1]
+                if end - start > n - pos:
+                    if pos > 0:
+                        break # does not fit, the window is padded instead of cutting the document off
+                    start += int(self.rng.integers(end - start - n + 1)) # longer than a window: a random window of it
+                length = min(end - start, n)
+                buf[row, pos:pos+length] = self.data[start:start+length]
+                docs[row, pos:pos+length] = doc
+                pos, doc = pos + length, doc + 1
+            buf[row, pos:] = -1
+            docs[row, pos:] = doc # the padding is a document of its own
+
+def eval_batches(data_dir, split, batch_size, block_size, device='cpu', packed=False):
+    """
+    One deterministic pass over a split, as a list of (X, Y, doc_ids) batches built once and kept on
+    device. The split is cut into consecutive windows that overlap by one token, the last token of a
+    window is the first input of the next, so every token but the first is a target exactly once.
+    With packed=True the windows are filled with the documents in order instead, a document that
+    does not fit starting the next window (and one longer than a window being split), like the
+    packed training batches; the overlap is kept there too. Positions past the end of the data are
+    padding with target -1, which the loss ignores, so weight each batch's mean loss with its
+    (Y >= 0).sum() to get the exact mean over the split.
+    """
+    data = np.fromfile(os.path.join(data_dir, f'{split}.bin'), dtype=np.uint16).astype(np.int64)
+    n = block_size + 1
+    windows, docs = [], []
+    if packed:
+        offsets = np.fromfile(os.path.join(data_dir, f'{split}_docs.bin'), dtype=np.uint32).astype(np.int64)
+        window, window_docs = [], [] # tokens and the index of the document each one comes from
+        carried = 0 # tokens at the start of window that are only inputs, the targets of the previous window
+        def close_window():
+            nonlocal window, window_docs, carried
+            windows.append(np.array(window))
+            # document ids count up from 0 within a window
+            docs.append(np.concatenate([[0], np.cumsum(np.diff(window_docs) != 0)]))
+            window, window_docs, carried = window[-1:], window_docs[-1:], 1
+        for d in range(len(offsets) - 1):
+            doc = data[offsets[d]:offsets[d + 1]]
+            if len(window) + len(doc) > n and len(window) > carried:
+                close_window()
+            while len(window) + len(doc) > n:
+                # longer than a window, the rest continues in the next one
+                take = n - len(window)
+                window.extend(doc[:take])
+                window_docs.extend([d] * take)
+                doc = doc[take:]
+                close_window()
+            window.extend(doc)
+            window_docs.extend([d] * len(doc))
+        if len(window) > carried:
+            close_window()
+    else:
+        windows = [data[start:start + n] for start in range(0, len(data) - 1, block_size)]
+    batches = []
+    for b in range(0, len(windows), batch_size):
+        w = torch.full((len(windows[b:b + batch_size]), n), -1, dtype=torch.int64)
+        d = torch.zeros_like(w)
+        for row, window in enumerate(windows[b:b + batch_size]):
+            w[row, :len(window)] = torch.from_numpy(window)
+            if packed:
+                d[row, :len(window)] = torch.from_numpy(docs[b + row])
+                d[row, len(window):] = docs[b + row][-1] + 1 # the padding is a document of its own
+        w, d = w.to(device), d.to(device)
+        # padding tokens are fed as token 0, they come after the real tokens and are never attended to
+        batches.append((w[:, :-1].clamp(min=0), w[:, 1:], d[:, :-1] if packed else None))
+    return batches
+
+def legacy_batch(path, batch_size, block_size):
+    """ the batch assembly train.py used before this loader, for the benchmark below """
+    data = np.memmap(path, dtype=np.uint16, mode='r')
+    ix = torch.randint(len(data) - block_size, (batch_size,))
+    x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
+    y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
+    return x, y
+
+# -----------------------------------------------------------------------------
+# benchmark: cost of assembling one batch (no prefetching), old vs vectorized
+if __name__ == '__main__':
+    dataset = 'processed_data'
+    batch_size = 12
+    block_sizes = (64, 256, 1024)
+    iters = 500
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    data_dir = os.path.join('data', dataset)
+    for block_size in block_sizes:
+        loader = PrefetchLoader(data_dir, 'train', batch_size, block_size, depth=0)
+        timings = {}
+        for name, fn in (('per-row', lambda: legacy_batch(loader.path, batch_size, block_size)), ('vectorized', lambda: loader._fill(0))):
+            fn()
+            t0 = time.perf_counter()
+            for _ in range(iters):
+                fn()
+            timings[name] = (time.perf_counter() - t0) / iters
+        print(f"block_size {block_size:5d}: per-row {timings['per-row']*1e6:8.1f} us/batch, "
+              f"vectorized {timings['vectorized']*1e6:8.1f} us/batch ({timings['per-row']/timings['vectorized']:.1f}x)")
@@ -0,0 +1,206 @@
+"""
+Continuous-batching inference engine around GPT.
+
+Requests arrive at any time and wait in a FIFO queue. Between two decode steps the scheduler
+admits as many waiting requests as fit into the token budget of the running batch. Each new
+request is prefilled on its own and its KV cache rows are merged into the running batch, which
+then decodes one token per row per step. A row is evicted from the batch as soon as it hits its
+stop condition, so short questions never wait for long answers to finish.
+
+With a PrefixCache (see prefix_cache.py) a new request only prefills the part of its prompt
+that comes after the longest prefix some earlier request already computed.
+
+With a KVBlockPool (see model.py) the KV caches are paged: every request only holds the pool
+blocks its tokens occupy so far, instead of a buffer of block_size positions, and evicting a
+row hands its blocks back for the next admission without copying the rest of the batch.
+>>> engine = InferenceEngine(model, kv_pool=KVBlockPool(model.config, num_blocks=2048))
+>>> engine.kv_pool.stats() # usage, fragmentation, ...
+
+Example:
+>>> engine = InferenceEngine(model, Scheduler(max_batch_size=16, max_batch_tokens=4096), PrefixCache())
+>>> done = engine.generate([Request(prompt=ids, max_new_tokens=150) for ids in prompts])
+"""
+
+import time
+import itertools
+from collections import deque
+from dataclasses import dataclass, field
+
+import torch
+
+import sampling
+from model import KVCache, PagedKVCache, ends_with_stop
+
+@dataclass
+class Request:
+    prompt: list # token indices of the prompt
+    max_new_tokens: int = 150
+    temperature: float = 1.0
+    top_k: int = None
+    top_p: float = None
+    min_p: float = None
+    seed: int = None # makes the sampled output reproducible regardless of the rest of the batch
+    stop: list = None # tokenizer.StopSequences or token index sequences that end the request (kept in the output)
+    # filled in by the engine
+    request_id: int = None
+    output: list = field(default_factory=list) # generated token indices
+    finish_reason: str = None # 'stop', 'length' (max_new_tokens or block_size reached), or None while running
+    arrival_time: float = None
+    first_token_time: float = None
+    finish_time: float = None
+    generator: torch.Generator = field(default=None, repr=False)
+
+    @property
+    def num_tokens(self):
+        return len(self.prompt) + len(self.output)
+
+class Scheduler:
+    """
+    FIFO admission control. A request is admitted once the running batch has a free row and
+    enough token budget left for its prompt plus max_new_tokens. Admission is strictly in arrival
+    order, a request that does not fit blocks the ones behind it so nothing gets starved.
+    With tokens_per_block > 1 reservations are rounded up to whole KV blocks, so a budget of the
+    pool's capacity guarantees that the running batch never runs out of blocks.
+    """
+
+    def __init__(self, max_batch_size=16, max_batch_tokens=4096, tokens_per_block=1):
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.tokens_per_block = tokens_per_block
+        self.waiting = deque() # append/popleft are thread-safe, requests can be added from anywhere
+
+    def add(self, request):
+        self.waiting.append(request)
+
+    def reserved_tokens(self, request, block_size):
+        # the most KV cache positions this request can ever occupy
+        need = min(len(request.prompt) + request.max_new_tokens, block_size)
+        return -(-need // self.tokens_per_block) * self.tokens_per_block
+
+    def schedule(self, running, block_size):
+        """ pop and return the waiting requests that can join the running batch right now """
+        budget = self.max_batch_tokens - sum(self.reserved_tokens(r, block_size) for r in running)
+        slots = self.max_batch_size - len(running)
+        admitted = []
+        while self.waiting and slots > 0:
+            need = self.reserved_tokens(self.waiting[0], block_size)
+            # an empty batch always takes the head of the queue, even if it alone is over budget
+            if need > budget and (running or admitted):
+                break
+            admitted.append(self.waiting.popleft())
+            budget -= need
+            slots -= 1
+        return admitted
+
+class InferenceEngine:
+
+    def __init__(self, model, scheduler=None, prefix_cache=None, kv_pool=None):
+        self.model = model
+        if scheduler is None:
+            # by default a paged engine admits as much as its block pool can hold
+            scheduler = Scheduler(max_batch_tokens=kv_pool.num_blocks * kv_pool.tokens_per_block,
+                                  tokens_per_block=kv_pool.tokens_per_block) if kv_pool is not None else Scheduler()
+        self.scheduler = scheduler
+        self.prefix_cache = prefix_cache
+        self.kv_pool = kv_pool
+        self.block_size = model.config.block_size
+        self.device = model.lm_head.weight.device
+        self.running = [] # requests in the running batch, in the same order as the kv_cache rows
+        self.kv_cache = None
+        self._ids = itertools.count()
+        # counters for throughput reporting
+        self.num_steps = 0
+        self.num_prefill_tokens = 0
+        self.num_generated_tokens = 0
+
+    def add_request(self, request):
+        """ queue a request, it will be admitted between two decode steps """
+        # a bad prompt would only fail in the middle of a batched step, along with the whole batch
+        if not request.prompt:
+            raise ValueError("empty prompt")
+        if min(request.prompt) < 0 or max(request.prompt) >= self.model.config.vocab_size:
+            raise ValueError(f"prompt token indices must be in [0, {self.model.config.vocab_size})")
+        request.request_id = next(self._ids)
+        request.arrival_time = time.time()
+        # only the last block_size tokens of an over-long prompt can be attended to anyway
+        request.prompt = list(request.prompt)[-self.block_size:]
+        self.scheduler.add(request)
+        return request.request_id
+
+    def has_unfinished(self):
+        return bool(self.running or self.scheduler.waiting)
+
+    @torch.no_grad()
+    def step(self):
+        """ run one decode step over the running batch, then admit new requests. returns the requests that finished """
+        finished = []
+        if self.running:
+            idx = torch.tensor([[r.output[-1]] for r in self.running], dtype=torch.long, device=self.device)
+            logits, _ = self.model(idx, kv_cache=self.kv_cache)
+            finished += self._append(self.running, logits[:, -1, :])
+            self._evict()
+        for request in self.scheduler.schedule(self.running, self.block_size):
+            kv_cache = PagedKVCache(self.kv_pool) if self.kv_pool is not None else KVCache(self.model.config)
+            cached = self.prefix_cache.load(request.prompt, kv_cache) if self.prefix_cache is not None else 0
+            idx = torch.tensor([request.prompt[cached:]], dtype=torch.long, device=self.device)
+            logits, _ = self.model(idx, kv_cache=kv_cache)
+            self.num_prefill_tokens += idx.size(1)
+            if self.prefix_cache is not None:
+                self.prefix_cache.insert(request.prompt, kv_cache)
+            finished += self._append([request], logits[:, -1, :])
+            if request.finish_reason is None:
+                self.running.append(request)
+                if self.kv_cache is None:
+                    self.kv_cache = kv_cache
+                else:
+                    self.kv_cache.extend(kv_cache)
+            else:
+                kv_cache.reset() # hands the blocks of a paged cache back to the pool
+        self.num_steps += 1
+        return finished
+
+    def generate(self, requests):
+        """ convenience: queue all requests and step until every one of them has finished """
+        for request in requests:
+            self.add_request(request)
+        while self.has_unfinished():
+            self.step()
+        return requests
+
+    def _append(self, requests, logits):
+        """ sample the next token of every request from its row of logits, mark finished ones """
+        for r in requests:
+            if r.seed is not None and r.generator is None:
+                r.generator = torch.Generator(device=logits.device).manual_seed(r.seed)
+        # one call for the whole batch, with the sampling settings of every row
+        idx_next = sampling.sample(logits, [r.temperature for r in requests], [r.top_k for r in requests],
+                                   [r.top_p for r in requests], [r.min_p for r in requests],
+                                   generators=[r.generator for r in requests]).view(-1)
+        now = time.time()
+        finished = []
+        for r, tok in zip(requests, idx_next.tolist()):
+            r.output.append(tok)
+            if r.first_token_time is None:
+                r.first_token_time = now
+            if r.stop is not None and ends_with_stop(r.output, r.stop):
+                r.finish_reason = 'stop'
+            elif len(r.output) >= r.max_new_tokens or r.num_tokens >= self.block_size:
+                # at block_size the next position would not fit into the cache
+                r.finish_reason = 'length'
+            if r.finish_reason is not None:
+                r.finish_time = now
+                finished.append(r)
+        self.num_generated_tokens += len(requests)
+        return finished
+
+    def _evict(self):
+        """ drop finished requests from the running batch and their rows from the KV cache """
+        keep = [row for row, r in enumerate(self.running) if r.finish_reason is None]
+        if len(keep) == len(self.running):
+            return
+        if keep:
+            self.kv_cache.select(torch.tensor(keep, dtype=torch.long, device=self.device))
+        else:
+            self.kv_cache.reset()
+            self.kv_cache = None
+        self.running = [self.running[row] for row in keep]
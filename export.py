@@ -0,0 +1,138 @@
+"""
+Export a trained GPT checkpoint into a frozen, ahead-of-time inference artifact with torch.export.
+The artifact holds two programs over a static-size KV cache, which aot_runtime.py runs without
+model.py or a ckpt.pt:
+- prefill: prompt indices (1, T) -> logits of the last position, KV cache
+- decode:  one index (1, 1), its position (1,), KV cache -> logits, updated KV cache
+
+$ python export.py --out_dir=out-cybersecurity-enhanced
+writes out_dir/export/ and compares cold start and per-token latency against the eager model.
+By default the programs are compiled to native code with AOTInductor, which needs a C++ compiler
+at export time (not at load time). --aoti=False keeps the plain, portable torch.export programs.
+"""
+
+import os
+import json
+import time
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from torch.export import Dim, export
+
+from model import GPTConfig, GPT
+
+def _qkv(attn, x):
+    """ query, key, value of CausalSelfAttention attn for x, each of shape (B, nh, T, hs) """
+    B, T, C = x.size()
+    q, k, v = attn.c_attn(x).split(attn.n_embd, dim=2)
+    return [t.view(B, T, attn.n_head, C // attn.n_head).transpose(1, 2) for t in (q, k, v)]
+
+def _proj(attn, y):
+    """ re-assemble the heads of y (B, nh, T, hs) and apply the output projection of attn """
+    B, nh, T, hs = y.size()
+    return attn.c_proj(y.transpose(1, 2).reshape(B, T, nh * hs))
+
+class Prefill(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.block_size = model.config.block_size
+
+    def forward(self, idx):
+        m = self.model
+        T = idx.size(1)
+        x = m.transformer.wte(idx) + m.transformer.wpe(torch.arange(T, device=idx.device))
+        kv = []
+        for block in m.transformer.h:
+            q, k, v = _qkv(block.attn, block.ln_1(x))
+            x = x + _proj(block.attn, F.scaled_dot_product_attention(q, k, v, is_causal=True))
+            x = x + block.mlp(block.ln_2(x))
+            # zero-pad keys/values up to the static cache length of the decode step
+            kv.append(F.pad(torch.stack((k, v)), (0, 0, 0, self.block_size - T)))
+        logits = m.lm_head(m.transformer.ln_f(x[:, -1, :]))
+        return logits, torch.stack(kv) # (vocab_size,), (n_layer, 2, 1, nh, block_size, hs)
+
+class DecodeStep(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.block_size = model.config.block_size
+
+    def forward(self, idx, pos, kv):
+        m = self.model
+        x = m.transformer.wte(idx) + m.transformer.wpe(pos)
+        attn_mask = (torch.arange(self.block_size, device=idx.device) <= pos)[None, :] # cached positions and this one
+        new_kv = []
+        for i, block in enumerate(m.transformer.h):
+            q, k, v = _qkv(block.attn, block.ln_1(x))
+            k, v = kv[i, 0].index_copy(2, pos, k), kv[i, 1].index_copy(2, pos, v)
+            x = x + _proj(block.attn, F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask))
+            x = x + block.mlp(block.ln_2(x))
+            new_kv.append(torch.stack((k, v)))
+        logits = m.lm_head(m.transformer.ln_f(x[:, -1, :]))
+        return logits, torch.stack(new_kv)
+
+def export_model(model, export_dir, aoti=False):
+    """ export an eval-mode GPT into export_dir, see aot_runtime.AOTModel for loading it """
+    cfg = model.config
+    os.makedirs(export_dir, exist_ok=True)
+    idx = torch.zeros(1, 2, dtype=torch.long)
+    kv = torch.zeros(cfg.n_layer, 2, 1, cfg.n_head, cfg.block_size, cfg.n_embd // cfg.n_head)
+    with torch.no_grad():
+        programs = {
+            'prefill': export(Prefill(model), (idx,), dynamic_shapes={'idx': {1: Dim('T', min=1, max=cfg.block_size)}}),
+            'decode': export(DecodeStep(model), (idx[:, :1], torch.tensor([2]), kv)),
+        }
+    for name, program in programs.items():
+        if aoti:
+            torch._inductor.aoti_compile_and_package(program, package_path=os.path.join(export_dir, f'{name}.pt2'))
+        else:
+            torch.export.save(program, os.path.join(export_dir, f'{name}.pt2'))
+    with open(os.path.join(export_dir, 'meta.json'), 'w') as f:
+        json.dump({'block_size': cfg.block_size, 'vocab_size': cfg.vocab_size, 'aoti': aoti}, f)
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    out_dir = 'out'
+    aoti = True # compile the exported programs to native code with AOTInductor (needs a C++ compiler)
+    bench = True # compare cold start and per-token latency against the eager model
+    max_new_tokens = 100 # tokens generated for the per-token latency measurement
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -------------------------------------------------------------------------
+    from aot_runtime import AOTModel
+    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
+    export_dir = os.path.join(out_dir, 'export')
+
+    def load_eager():
+        checkpoint = torch.load(ckpt_path, map_location='cpu')
+        return GPT.meta(GPTConfig(**checkpoint['model_args'])).assign_state_dict(checkpoint['model']).eval()
+
+    t0 = time.time()
+    export_model(load_eager(), export_dir, aoti)
+    print(f"exported {ckpt_path} to {export_dir} in {time.time() - t0:.1f}s")
+
+    if bench:
+        prompt = [0] * 16
+        # cold start: load from disk until the first token is sampled
+        torch.manual_seed(1337)
+        t0 = time.time()
+        eager = load_eager()
+        eager.generate(torch.tensor([prompt]), 1)
+        eager_cold = time.time() - t0
+        t0 = time.time()
+        aot = AOTModel(export_dir)
+        aot.generate(prompt, 1)
+        aot_cold = time.time() - t0
+        # steady state: per-token latency of the decode loop
+        with torch.no_grad():
+            t0 = time.time()
+            eager.generate(torch.tensor([prompt]), max_new_tokens)
+            eager_tok = (time.time() - t0) / max_new_tokens
+        t0 = time.time()
+        aot.generate(prompt, max_new_tokens)
+        aot_tok = (time.time() - t0) / max_new_tokens
+        print(f"eager: cold start {eager_cold*1000:.1f}ms, {eager_tok*1000:.2f}ms/token")
+        print(f"aot:   cold start {aot_cold*1000:.1f}ms, {aot_tok*1000:.2f}ms/token")
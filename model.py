@@ -9,12 +9,15 @@ https://github.com/huggingface/transformers/blob/main/src/transformers/models/gp
 
 import math
 import inspect
+import weakref
 from dataclasses import dataclass
 
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
+import sampling
+
 class LayerNorm(nn.Module):
     """ LayerNorm but with an optional bias. PyTorch doesn't support simply bias=False """
 
@@ -26,9 +29,252 @@ class LayerNorm(nn.Module):
     def forward(self, input):
         return F.layer_norm(input, self.weight.shape, self.weight, self.bias, 1e-5)
 
-class CausalSelfAttention(nn.Module):
+class KVCache:
+    """
+    Per-layer key/value cache for incremental decoding. Buffers of shape (B, nh, block_size, hs)
+    are allocated lazily on the first update of each layer and then filled in place, so decoding
+    one token only computes and stores that token's keys/values. GPT.forward advances seq_len
+    once every layer has been updated.
+    """
 
     def __init__(self, config):
+        self.max_len = config.block_size
+        self.n_layer = config.n_layer
+        self.k = [None] * config.n_layer
+        self.v = [None] * config.n_layer
+        self.seq_len = 0 # number of positions currently held by the cache
+        self.pad = None # (B,) LongTensor of left-padding positions per row, None if no row is padded
+
+    def get_seq_length(self):
+        return self.seq_len
+
+    def reset(self):
+        # forget all positions but keep the buffers around for reuse
+        self.seq_len = 0
+        self.pad = None
+
+    def update(self, layer_idx, k, v):
+        """ append k, v of shape (B, nh, T, hs) for layer_idx, return the keys/values of all positions """
+        B, nh, T, hs = k.size()
+        start, end = self.seq_len, self.seq_len + T
+        assert end <= self.max_len, f"KV cache overflow: {end} > {self.max_len}"
+        if self.k[layer_idx] is None or self.k[layer_idx].size(0) != B:
+            self.k[layer_idx] = k.new_empty(B, nh, self.max_len, hs)
+            self.v[layer_idx] = v.new_empty(B, nh, self.max_len, hs)
+        self.k[layer_idx][:, :, start:end] = k
+        self.v[layer_idx][:, :, start:end] = v
+        return self.k[layer_idx][:, :, :end], self.v[layer_idx][:, :, :end]
+
+    def get(self, layer_idx, start, end):
+        """ the cached keys/values of positions start:end of layer_idx, shape (B, nh, end - start, hs) """
+        return self.k[layer_idx][:, :, start:end], self.v[layer_idx][:, :, start:end]
+
+    def select(self, rows):
+        """
+        keep only the batch rows given by the LongTensor rows, e.g. to drop finished sequences.
+        a row given several times is forked into independent copies
+        """
+        # left padding that none of the remaining rows needs anymore is dropped as well
+        shift = int(self.pad[rows].min()) if self.pad is not None else 0
+        length = self.seq_len - shift
+        for i in range(len(self.k)):
+            if self.k[i] is None:
+                continue
+            for buf in (self.k, self.v):
+                new = buf[i].new_empty(len(rows), *buf[i].shape[1:])
+                new[:, :, :length] = buf[i][rows, :, shift:self.seq_len]
+                buf[i] = new
+        self.seq_len = length
+        if self.pad is not None:
+            self.pad = self.pad[rows] - shift
+            if not self.pad.any():
+                self.pad = None
+
+    def extend(self, other):
+        """ append the batch rows of another KVCache, left-padding whichever of the two is shorter """
+        length = max(self.seq_len, other.seq_len)
+        pads = []
+        for cache in (self, other):
+            n = next(k.size(0) for k in cache.k if k is not None)
+            pad = cache.pad if cache.pad is not None else torch.zeros(n, dtype=torch.long, device=cache.k[0].device)
+            pads.append(pad + (length - cache.seq_len))
+        for i in range(len(self.k)):
+            for buf, other_buf in ((self.k, other.k), (self.v, other.v)):
+                a, b = buf[i], other_buf[i]
+                # zeros, not empty: the padded keys/values get masked out but must stay finite
+                new = a.new_zeros(a.size(0) + b.size(0), *a.shape[1:])
+                new[:a.size(0), :, length - self.seq_len:length] = a[:, :, :self.seq_len]
+                new[a.size(0):, :, length - other.seq_len:length] = b[:, :, :other.seq_len]
+                buf[i] = new
+        self.seq_len = length
+        self.pad = torch.cat(pads)
+        if not self.pad.any():
+            self.pad = None
+
+class KVBlockPool:
+    """
+    Fixed-size pool of KV cache blocks shared by all sequences, for PagedKVCache. Every block
+    holds the keys/values of tokens_per_block positions of every layer, so memory is allocated in
+    small blocks as sequences grow instead of block_size positions per sequence up front, and the
+    blocks of a finished sequence are immediately reusable by any other one.
+    """
+
+    def __init__(self, config, num_blocks, tokens_per_block=16, dtype=torch.float32, device='cpu'):
+        self.num_blocks = num_blocks
+        self.tokens_per_block = tokens_per_block
+        hs = config.n_embd // config.n_head
+        # zeros, not empty: slots are also read for (masked out) padding and must stay finite
+        self.k = [torch.zeros(num_blocks * tokens_per_block, config.n_head, hs, dtype=dtype, device=device) for _ in range(config.n_layer)]
+        self.v = [torch.zeros(num_blocks * tokens_per_block, config.n_head, hs, dtype=dtype, device=device) for _ in range(config.n_layer)]
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+        self.caches = weakref.WeakSet() # live PagedKVCaches, for stats()
+        self.peak_used_blocks = 0
+
+    def allocate(self):
+        if not self.free_blocks:
+            raise RuntimeError(f"KV block pool exhausted, all {self.num_blocks} blocks are in use")
+        block = self.free_blocks.pop()
+        self.peak_used_blocks = max(self.peak_used_blocks, self.num_blocks - len(self.free_blocks))
+        return block
+
+    def free(self, blocks):
+        self.free_blocks.extend(blocks)
+
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.k + self.v)
+
+    def stats(self):
+        """ usage and fragmentation (the unused tail slots of allocated blocks) of the pool """
+        used = self.num_blocks - len(self.free_blocks)
+        allocated = used * self.tokens_per_block
+        stored = sum(cache.num_tokens() for cache in self.caches)
+        return dict(num_blocks=self.num_blocks, used_blocks=used, free_blocks=len(self.free_blocks),
+                    usage=used / self.num_blocks, peak_used_blocks=self.peak_used_blocks,
+                    allocated_tokens=allocated, stored_tokens=stored,
+                    fragmentation=1 - stored / allocated if allocated else 0.0)
+
+class PagedKVCache:
+    """
+    Drop-in replacement for KVCache that keeps keys/values in the blocks of a KVBlockPool. Every
+    row has a block table, the list of its blocks in order, and only its real tokens are stored:
+    the left-padded layout (seq_len, pad) that GPT.forward works with is only logical. update()
+    writes the new tokens into their blocks and gathers the keys/values of all positions for
+    attention, select() and extend() only move block tables around instead of copying buffers.
+    reset() returns all blocks to the pool.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.n_layer = len(pool.k)
+        self.tables = [] # block table of every row
+        self.seq_len = 0 # number of (logical, left-padded) positions currently held by the cache
+        self.pad = None # (B,) LongTensor of left-padding positions per row, None if no row is padded
+        self._read_slots = None # (B, seq_len + T) pool slot of every position of the current forward
+        pool.caches.add(self)
+
+    def get_seq_length(self):
+        return self.seq_len
+
+    def num_tokens(self):
+        """ the number of real (not padding) tokens stored for all rows """
+        if not self.tables:
+            return 0
+        return len(self.tables) * self.seq_len - (int(self.pad.sum()) if self.pad is not None else 0)
+
+    def reset(self):
+        for table in self.tables:
+            self.pool.free(table)
+        self.tables = []
+        self.seq_len = 0
+        self.pad = None
+
+    def update(self, layer_idx, k, v):
+        """ append k, v of shape (B, nh, T, hs) for layer_idx, return the keys/values of all positions """
+        B, nh, T, hs = k.size()
+        if layer_idx == 0:
+            self._prepare(B, T, k.device)
+        # the new tokens of every row, minus those in the left padding
+        src = self._write_src
+        self.pool.k[layer_idx][self._write_slots] = k.transpose(1, 2).reshape(B * T, nh, hs)[src].to(self.pool.k[layer_idx].dtype)
+        self.pool.v[layer_idx][self._write_slots] = v.transpose(1, 2).reshape(B * T, nh, hs)[src].to(self.pool.v[layer_idx].dtype)
+        return self._gather(layer_idx, self._read_slots, k.dtype)
+
+    def get(self, layer_idx, start, end):
+        """ the cached keys/values of positions start:end of layer_idx, shape (B, nh, end - start, hs) """
+        slots = self._slots(torch.arange(start, end, device=self.pool.k[0].device))
+        return self._gather(layer_idx, slots, self.pool.k[layer_idx].dtype)
+
+    def select(self, rows):
+        """ keep only the batch rows given by the LongTensor rows, the blocks of the others are freed """
+        keep = rows.tolist()
+        assert len(set(keep)) == len(keep), "rows of a PagedKVCache cannot be forked"
+        for row in set(range(len(self.tables))) - set(keep):
+            self.pool.free(self.tables[row])
+        self.tables = [self.tables[row] for row in keep]
+        if self.pad is not None:
+            # left padding that none of the remaining rows needs anymore is dropped as well
+            self.pad = self.pad[rows]
+            shift = int(self.pad.min())
+            self.seq_len -= shift
+            self.pad = self.pad - shift
+            if not self.pad.any():
+                self.pad = None
+
+    def extend(self, other):
+        """ append the batch rows of another PagedKVCache on the same pool, other is left empty """
+        assert other.pool is self.pool, "both caches must share the block pool"
+        length = max(self.seq_len, other.seq_len)
+        pads = []
+        for cache in (self, other):
+            pad = cache.pad if cache.pad is not None else torch.zeros(len(cache.tables), dtype=torch.long, device=self.pool.k[0].device)
+            pads.append(pad + (length - cache.seq_len))
+        self.tables = self.tables + other.tables
+        self.seq_len = length
+        self.pad = torch.cat(pads)
+        if not self.pad.any():
+            self.pad = None
+        # the blocks belong to self now
+        other.tables, other.seq_len, other.pad = [], 0, None
+
+    def _prepare(self, B, T, device):
+        """ allocate the blocks for T more positions and compute the pool slots of this forward """
+        if not self.tables:
+            self.tables = [[] for _ in range(B)]
+        assert len(self.tables) == B, f"cache holds {len(self.tables)} rows, got {B}"
+        end = self.seq_len + T
+        pad = self.pad.tolist() if self.pad is not None else [0] * B
+        for table, p in zip(self.tables, pad):
+            needed = -(-max(end - p, 0) // self.pool.tokens_per_block)
+            while len(table) < needed:
+                table.append(self.pool.allocate())
+        positions = torch.arange(end, device=device)
+        self._read_slots = self._slots(positions)
+        new = self._read_slots[:, self.seq_len:]
+        valid = positions[None, self.seq_len:] >= (self.pad[:, None] if self.pad is not None else 0)
+        valid = valid.expand(B, T)
+        self._write_slots = new[valid]
+        self._write_src = valid.reshape(-1).nonzero().squeeze(1)
+
+    def _slots(self, positions):
+        """ (B, len(positions)) pool slots of logical positions, padding points at slot 0 """
+        n = self.pool.tokens_per_block
+        width = max(1, max(len(t) for t in self.tables))
+        table = torch.tensor([t + [0] * (width - len(t)) for t in self.tables], dtype=torch.long, device=positions.device)
+        local = positions[None, :] - (self.pad[:, None] if self.pad is not None else 0) # token index within the row
+        valid = local >= 0
+        local = local.clamp(min=0)
+        slots = table.gather(1, (local // n).clamp(max=width - 1)) * n + local % n
+        return slots.masked_fill(~valid, 0)
+
+    def _gather(self, layer_idx, slots, dtype):
+        B, L = slots.size()
+        k = self.pool.k[layer_idx][slots.view(-1)].view(B, L, *self.pool.k[layer_idx].shape[1:]).transpose(1, 2)
+        v = self.pool.v[layer_idx][slots.view(-1)].view(B, L, *self.pool.v[layer_idx].shape[1:]).transpose(1, 2)
+        return k.to(dtype), v.to(dtype)
+
+class CausalSelfAttention(nn.Module):
+
+    def __init__(self, config, layer_idx=0):
         super().__init__()
         assert config.n_embd % config.n_head == 0
         # key, query, value projections for all heads, but in a batch
@@ -41,6 +287,7 @@ class CausalSelfAttention(nn.Module):
         self.n_head = config.n_head
         self.n_embd = config.n_embd
         self.dropout = config.dropout
+        self.layer_idx = layer_idx # which slot of a KVCache this layer reads and writes
         # flash attention make GPU go brrrrr but support is only in PyTorch >= 2.0
         self.flash = hasattr(torch.nn.functional, 'scaled_dot_product_attention')
         if not self.flash:
@@ -49,7 +296,7 @@ class CausalSelfAttention(nn.Module):
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                         .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None, attn_mask=None):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -57,15 +304,26 @@ class CausalSelfAttention(nn.Module):
         k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
+        if kv_cache is not None:
+            # store the new keys/values and attend over all cached positions
+            k, v = kv_cache.update(self.layer_idx, k, v)
+        Tk = k.size(2) # number of key positions, T + number of cached positions
 
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
+        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, Tk) -> (B, nh, T, Tk)
         if self.flash:
             # efficient attention using Flash Attention CUDA kernels
-            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=self.dropout if self.training else 0, is_causal=True)
+            # the queries are the last T of the Tk positions: a single query sees everything,
+            # several queries on top of a cache need the causal mask shifted by Tk - T
+            if attn_mask is None and T > 1 and Tk > T:
+                attn_mask = torch.ones(T, Tk, dtype=torch.bool, device=x.device).tril(diagonal=Tk - T)
+            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=self.dropout if self.training else 0, is_causal=(attn_mask is None and T == Tk and T > 1))
         else:
             # manual implementation of attention
             att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-            att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
+            if attn_mask is not None:
+                att = att.masked_fill(~attn_mask, float('-inf'))
+            else:
+                att = att.masked_fill(self.bias[:,:,Tk-T:Tk,:Tk] == 0, float('-inf'))
             att = F.softmax(att, dim=-1)
             att = self.attn_dropout(att)
             y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
@@ -93,15 +351,15 @@ class MLP(nn.Module):
 
 class Block(nn.Module):
 
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=0):
         super().__init__()
         self.ln_1 = LayerNorm(config.n_embd, bias=config.bias)
-        self.attn = CausalSelfAttention(config)
+        self.attn = CausalSelfAttention(config, layer_idx)
         self.ln_2 = LayerNorm(config.n_embd, bias=config.bias)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, kv_cache=None, attn_mask=None):
+        x = x + self.attn(self.ln_1(x), kv_cache, attn_mask)
         x = x + self.mlp(self.ln_2(x))
         return x
 
@@ -127,7 +385,7 @@ class GPT(nn.Module):
             wte = nn.Embedding(config.vocab_size, config.n_embd),
             wpe = nn.Embedding(config.block_size, config.n_embd),
             drop = nn.Dropout(config.dropout),
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            h = nn.ModuleList([Block(config, i) for i in range(config.n_layer)]),
             ln_f = LayerNorm(config.n_embd, bias=config.bias),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
@@ -167,30 +425,87 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, kv_cache=None, num_logits=1, doc_ids=None):
+        """
+        If a KVCache is given, idx holds only the tokens that come after the cached positions.
+        Their keys/values are appended to the cache in place, so the next call can continue
+        from where this one stopped. Without targets, logits are only computed for the last
+        num_logits positions.
+        doc_ids (LongTensor of shape (b, t), non-decreasing along t) marks rows that pack several
+        documents: a token only attends to the tokens of its own document and positions restart
+        at 0 at the start of every document, as if each one had been forwarded on its own.
+        """
+        x = self._hidden(idx, kv_cache, doc_ids=doc_ids)
+
+        if targets is not None:
+            # if we are given some desired targets also calculate the loss
+            logits = self.lm_head(x)
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.reshape(-1), ignore_index=-1)
+        else:
+            # inference-time mini-optimization: only forward the lm_head on the very last position(s)
+            logits = self.lm_head(x[:, -num_logits:, :]) # note: slicing preserves the time dim
+            loss = None
+
+        return logits, loss
+
+    def _hidden(self, idx, kv_cache=None, pad=None, doc_ids=None):
+        """ final-layer (ln_f) hidden states of shape (b, t, n_embd), see forward() """
         device = idx.device
         b, t = idx.size()
-        assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device) # shape (t)
+        past = kv_cache.get_seq_length() if kv_cache is not None else 0
+        assert past + t <= self.config.block_size, f"Cannot forward sequence of length {past + t}, block size is only {self.config.block_size}"
+        pos = torch.arange(past, past + t, dtype=torch.long, device=device) # shape (t)
+        attn_mask = None
+        if kv_cache is not None:
+            pad = kv_cache.pad
+        if pad is not None:
+            # left-padded batch: positions count from the first real token of each row and keys in
+            # the padding are masked out. a padding query still sees itself to keep softmax finite
+            key_pos = torch.arange(past + t, device=device)
+            attn_mask = (key_pos[None, None, :] >= pad[:, None, None]) | (key_pos[None, None, :] == pos[None, :, None])
+            attn_mask = attn_mask & (key_pos[None, :] <= pos[:, None]) # causal, shape (b, t, past + t)
+            attn_mask = attn_mask[:, None] # broadcast over heads
+            pos = (pos[None, :] - pad[:, None]).clamp(min=0) # shape (b, t)
+        if doc_ids is not None:
+            assert kv_cache is None, "packed documents are a training-time input"
+            # block-diagonal causal mask, and positions counted from the start of each document
+            attn_mask = (doc_ids[:, :, None] == doc_ids[:, None, :]) & torch.ones(t, t, dtype=torch.bool, device=device).tril()
+            attn_mask = attn_mask[:, None] # broadcast over heads
+            starts = torch.ones_like(doc_ids, dtype=torch.bool)
+            starts[:, 1:] = doc_ids[:, 1:] != doc_ids[:, :-1]
+            pos = pos - torch.cummax(torch.where(starts, pos, 0), dim=1).values # shape (b, t)
 
         # forward the GPT model itself
         tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
-        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd)
+        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd) or (b, t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
         for block in self.transformer.h:
-            x = block(x)
-        x = self.transformer.ln_f(x)
+            x = block(x, kv_cache, attn_mask)
+        if kv_cache is not None:
+            kv_cache.seq_len += t
+        return self.transformer.ln_f(x)
 
-        if targets is not None:
-            # if we are given some desired targets also calculate the loss
-            logits = self.lm_head(x)
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
+    @torch.no_grad()
+    def embed(self, prompts, pooling='mean'):
+        """
+        Embed a list of prompts (lists of token indices, possibly of different lengths) as one
+        left-padded batch. The final-layer (ln_f) hidden states of every prompt are pooled over its
+        tokens ('mean') or taken at its last token ('last'), and L2-normalized so the dot product
+        of two embeddings is their cosine similarity. Prompts longer than block_size keep their
+        last block_size tokens. Returns a float tensor of shape (len(prompts), n_embd).
+        """
+        assert pooling in ('mean', 'last')
+        device = self.lm_head.weight.device
+        idx, pad = self._left_pad([list(p)[-self.config.block_size:] for p in prompts], device)
+        x = self._hidden(idx, pad=pad).float()
+        if pooling == 'last':
+            emb = x[:, -1]
         else:
-            # inference-time mini-optimization: only forward the lm_head on the very last position
-            logits = self.lm_head(x[:, [-1], :]) # note: using list [-1] to preserve the time dim
-            loss = None
-
-        return logits, loss
+            # average over the real tokens only, the padding is on the left
+            pad = pad if pad is not None else torch.zeros(idx.size(0), dtype=torch.long, device=device)
+            real = (torch.arange(idx.size(1), device=device)[None, :] >= pad[:, None]).float()
+            emb = (x * real[..., None]).sum(1) / real.sum(1, keepdim=True)
+        return F.normalize(emb, dim=-1)
 
     def crop_block_size(self, block_size):
         # model surgery to decrease the block size if necessary
@@ -203,6 +518,38 @@ class GPT(nn.Module):
             if hasattr(block.attn, 'bias'):
                 block.attn.bias = block.attn.bias[:,:,:block_size,:block_size]
 
+    @classmethod
+    def meta(cls, config):
+        """
+        A GPT with its parameters on the meta device: nothing is allocated and no weight init runs.
+        Only good for loading a checkpoint into it with assign_state_dict (quantize_model works on
+        it too, to load a quantized checkpoint).
+        """
+        with torch.device('meta'):
+            return cls(config)
+
+    def assign_state_dict(self, state_dict):
+        """
+        Load state_dict by making its tensors the parameters and buffers of this model instead of
+        copying them in, which also materializes a model built by GPT.meta. Returns the model.
+        """
+        # compiled models save their keys with this prefix
+        unwanted_prefix = '_orig_mod.'
+        state_dict = {k[len(unwanted_prefix):] if k.startswith(unwanted_prefix) else k: v for k, v in state_dict.items()}
+        missing, unexpected = self.load_state_dict(state_dict, strict=False, assign=True)
+        assert not unexpected and all(k.endswith('.attn.bias') for k in missing), f"missing keys {missing}, unexpected keys {unexpected}"
+        if isinstance(self.transformer.wte, nn.Embedding):
+            self.transformer.wte.weight = self.lm_head.weight # assign replaced the tied parameter
+        # the causal mask of the non-flash attention is a constant, one copy serves all layers
+        mask = None
+        for block in self.transformer.h:
+            if hasattr(block.attn, 'bias') and block.attn.bias.is_meta:
+                if mask is None:
+                    n = self.config.block_size
+                    mask = torch.tril(torch.ones(n, n, device=self.lm_head.weight.device)).view(1, 1, n, n)
+                block.attn.bias = mask
+        return self
+
     @classmethod
     def from_pretrained(cls, model_type, override_args=None):
         assert model_type in {'gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'}
@@ -227,9 +574,9 @@ class GPT(nn.Module):
         if 'dropout' in override_args:
             print(f"overriding dropout rate to {override_args['dropout']}")
             config_args['dropout'] = override_args['dropout']
-        # create a from-scratch initialized minGPT model
+        # create a minGPT model without allocating or initializing its weights
         config = GPTConfig(**config_args)
-        model = GPT(config)
+        model = GPT.meta(config)
         sd = model.state_dict()
         sd_keys = sd.keys()
         sd_keys = [k for k in sd_keys if not k.endswith('.attn.bias')] # discard this mask / buffer, not a param
@@ -238,7 +585,7 @@ class GPT(nn.Module):
         model_hf = GPT2LMHeadModel.from_pretrained(model_type)
         sd_hf = model_hf.state_dict()
 
-        # copy while ensuring all of the parameters are aligned and match in names and shapes
+        # take over the tensors while ensuring all of the parameters are aligned and match in names and shapes
         sd_keys_hf = sd_hf.keys()
         sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.masked_bias')] # ignore these, just a buffer
         sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.bias')] # same, just the mask (buffer)
@@ -246,17 +593,17 @@ class GPT(nn.Module):
         # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla Linear
         # this means that we have to transpose these weights when we import them
         assert len(sd_keys_hf) == len(sd_keys), f"mismatched keys: {len(sd_keys_hf)} != {len(sd_keys)}"
+        sd_new = {}
         for k in sd_keys_hf:
             if any(k.endswith(w) for w in transposed):
                 # special treatment for the Conv1D weights we need to transpose
                 assert sd_hf[k].shape[::-1] == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k].t())
+                sd_new[k] = sd_hf[k].t().contiguous()
             else:
-                # vanilla copy over the other parameters
+                # vanilla take over the other parameters
                 assert sd_hf[k].shape == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k])
+                sd_new[k] = sd_hf[k]
+        model.assign_state_dict(sd_new)
 
         return model
 
@@ -303,28 +650,217 @@ class GPT(nn.Module):
         return mfu
 
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, stop=None, top_p=None, min_p=None, context_stride=1):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        The prompt is forwarded once to fill a KVCache, after that each step only forwards the
+        newest token.
+        stop is an optional list of token index sequences (e.g. the encoding of '</A>'). A row is
+        done once its generated tokens end with one of them, and generation ends as soon as every
+        row is done. Rows that finish before the others are right-padded with -1.
+        See sampling.py for temperature (0 is greedy), top_k, top_p and min_p.
+        Once the sequence outgrows block_size the model only sees its last block_size tokens, and
+        since the position embeddings shift with the window, the window is recomputed from scratch
+        for every new token. context_stride > 1 amortizes this: the window is cropped to
+        block_size - context_stride + 1 tokens, the next context_stride - 1 tokens are decoded
+        on top of its cache, and only then is it recomputed. This costs about 1/context_stride
+        of the recompute, at the price of a context that varies between block_size and
+        block_size - context_stride + 1 tokens (see bench_context.py for the trade-off).
         """
-        for _ in range(max_new_tokens):
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
-            # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
-            # apply softmax to convert logits to (normalized) probabilities
-            probs = F.softmax(logits, dim=-1)
-            # sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1)
+        done = [False] * idx.size(0)
+        outs = [[] for _ in range(idx.size(0))] # generated tokens of every row, to match stops against
+        for idx_next in self._decode(idx, max_new_tokens, temperature, top_k, top_p, min_p, context_stride):
+            if stop is not None:
+                idx_next = idx_next.masked_fill(torch.tensor(done, device=idx.device)[:, None], -1)
+                for row, tok in enumerate(idx_next.view(-1).tolist()):
+                    outs[row].append(tok)
+                    done[row] = done[row] or ends_with_stop(outs[row], stop)
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
+            if all(done):
+                break
 
         return idx
+
+    @torch.no_grad()
+    def stream(self, idx, max_new_tokens, temperature=1.0, top_k=None, stop=None, top_p=None, min_p=None, context_stride=1):
+        """
+        Same as generate() for a single sequence idx of shape (1, t), but as a generator that
+        yields every new token index as soon as it is sampled. Stop iterating to stop generating.
+        """
+        assert idx.size(0) == 1, "stream() works on a single sequence"
+        tokens = []
+        for idx_next in self._decode(idx, max_new_tokens, temperature, top_k, top_p, min_p, context_stride):
+            tokens.append(idx_next.item())
+            yield tokens[-1]
+            if stop is not None and ends_with_stop(tokens, stop):
+                return
+
+    def _decode(self, idx, max_new_tokens, temperature, top_k, top_p, min_p, context_stride):
+        """ the decode loop behind generate() and stream(), yields the sampled indices (b, 1) of each step """
+        kv_cache = KVCache(self.config)
+        for _ in range(max_new_tokens):
+            if 0 < kv_cache.get_seq_length() < self.config.block_size:
+                # the cache holds every position except the token sampled last step
+                logits, _ = self(idx[:, -1:], kv_cache=kv_cache)
+            else:
+                # (re)fill the cache. if the sequence context is growing too long we must crop it
+                # at block_size, and since the position embeddings then shift with the window it
+                # has to be recomputed from scratch, every context_stride tokens (see generate())
+                idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self._window(context_stride):]
+                kv_cache.reset()
+                logits, _ = self(idx_cond, kv_cache=kv_cache)
+            # pluck the logits at the final step and sample the next index
+            idx_next = sampling.sample(logits[:, -1, :], temperature, top_k, top_p, min_p)
+            idx = torch.cat((idx, idx_next), dim=1)
+            yield idx_next
+
+    @torch.no_grad()
+    def generate_batch(self, prompts, max_new_tokens, temperature=1.0, top_k=None, stop=None, top_p=None, min_p=None, num_return_sequences=1, context_stride=1):
+        """
+        Complete a list of prompts (lists of token indices, possibly of different lengths) together
+        as one batch. The prompts are left-padded and masked so every row is computed as if it was
+        generated on its own. max_new_tokens is an int or one int per prompt, and a row also
+        finishes once its output ends with one of the stop sequences (which is kept in the output).
+        Finished rows are dropped from the batch. Returns a list with the generated token indices
+        of each prompt. The sampling settings are shared or given per prompt, see sampling.py.
+        With num_return_sequences = n every prompt is completed n times: its prompt is prefilled
+        once and the cache rows are forked into n rows that decode together, and the returned
+        list holds the n completions of the first prompt, then the n of the second one, etc.
+        context_stride works as in generate().
+        """
+        device = self.lm_head.weight.device
+        if isinstance(max_new_tokens, int):
+            max_new_tokens = [max_new_tokens] * len(prompts)
+        if num_return_sequences > 1:
+            fork = lambda x: [v for v in x for _ in range(num_return_sequences)]
+            prompts, max_new_tokens = fork(prompts), fork(max_new_tokens)
+            temperature, top_k, top_p, min_p = (fork(x) if isinstance(x, (list, tuple)) else x for x in (temperature, top_k, top_p, min_p))
+        n = len(prompts)
+        seqs = [list(p) for p in prompts] # prompt + completion of every row
+        out = [[] for _ in range(n)]
+        active = [i for i in range(n) if max_new_tokens[i] > 0] # rows still in the batch, in order
+        per_row = lambda x: [x[i] for i in active] if isinstance(x, (list, tuple)) else x
+        kv_cache = KVCache(self.config)
+        while active:
+            if 0 < kv_cache.get_seq_length() < self.config.block_size:
+                idx_cond = torch.tensor([[seqs[i][-1]] for i in active], dtype=torch.long, device=device)
+                logits, _ = self(idx_cond, kv_cache=kv_cache)
+            else:
+                # (re)fill the cache from the last tokens of every row, see generate(). rows with
+                # the same tokens (several samples of one prompt) are computed only once
+                windows = [tuple(seqs[i] if len(seqs[i]) <= self.config.block_size else seqs[i][-self._window(context_stride):]) for i in active]
+                unique = {w: row for row, w in enumerate(dict.fromkeys(windows))}
+                kv_cache.reset()
+                idx_cond, kv_cache.pad = self._left_pad(list(unique), device)
+                logits, _ = self(idx_cond, kv_cache=kv_cache)
+                if len(unique) < len(windows):
+                    rows = torch.tensor([unique[w] for w in windows], dtype=torch.long, device=device)
+                    kv_cache.select(rows)
+                    logits = logits[rows]
+            idx_next = sampling.sample(logits[:, -1, :], per_row(temperature), per_row(top_k), per_row(top_p), per_row(min_p)).view(-1).tolist()
+            keep = []
+            for row, (i, tok) in enumerate(zip(active, idx_next)):
+                seqs[i].append(tok)
+                out[i].append(tok)
+                if len(out[i]) < max_new_tokens[i] and not (stop is not None and ends_with_stop(out[i], stop)):
+                    keep.append(row)
+            if len(keep) < len(active):
+                if keep:
+                    kv_cache.select(torch.tensor(keep, dtype=torch.long, device=device))
+                active = [active[row] for row in keep]
+
+        return out
+
+    def _window(self, context_stride):
+        """ number of tokens kept when an over-long sequence is cropped, see generate() """
+        assert 1 <= context_stride <= self.config.block_size, f"context_stride must be in [1, {self.config.block_size}]"
+        return self.config.block_size - context_stride + 1
+
+    @staticmethod
+    def _left_pad(seqs, device):
+        """ left-pad lists of token indices into a (b, t) LongTensor, also return the per-row padding """
+        t = max(len(s) for s in seqs)
+        idx = torch.zeros(len(seqs), t, dtype=torch.long)
+        for row, s in enumerate(seqs):
+            idx[row, t - len(s):] = torch.tensor(s, dtype=torch.long)
+        pad = torch.tensor([t - len(s) for s in seqs], dtype=torch.long)
+        return idx.to(device), (pad.to(device) if pad.any() else None)
+
+    @torch.no_grad()
+    def generate_speculative(self, idx, draft_model, max_new_tokens, num_draft_tokens=4, temperature=1.0, top_k=None, stop=None, top_p=None, min_p=None):
+        """
+        Speculative decoding of a single sequence idx of shape (1, t). The small draft_model proposes
+        num_draft_tokens tokens one at a time and this (target) model scores all of them in one
+        forward pass. Draft token x is accepted with probability min(1, p(x)/q(x)) and the first
+        rejected one is resampled from max(0, p - q), so the output is distributed exactly as
+        sampling from this model alone. Both models must share the vocabulary. Once the sequence
+        no longer fits into either block_size the rest is decoded by generate().
+        Returns the completed idx and a dict of acceptance statistics.
+        """
+        assert idx.size(0) == 1, "speculative decoding works on a single sequence"
+        assert draft_model.config.vocab_size == self.config.vocab_size, "draft and target vocab differ"
+        device = idx.device
+        seq = idx[0].tolist() # prompt + everything accepted so far
+        out = [] # generated tokens
+        target_cache, draft_cache = KVCache(self.config), KVCache(draft_model.config)
+        block_size = min(self.config.block_size, draft_model.config.block_size)
+        stats = dict(rounds=0, drafted=0, accepted=0)
+        while len(out) < max_new_tokens and len(seq) <= block_size:
+            if stop is not None and ends_with_stop(out, stop):
+                break
+            # the round yields up to k+1 tokens, and the caches grow by k positions at most
+            k = max(0, min(num_draft_tokens, max_new_tokens - len(out) - 1, block_size - len(seq)))
+            # 1) draft k tokens autoregressively, remembering the draft distribution q of each
+            draft_tokens, draft_probs = [], []
+            if k > 0:
+                logits, _ = draft_model(torch.tensor([seq[draft_cache.seq_len:]], device=device), kv_cache=draft_cache)
+                for i in range(k):
+                    q = sampling.probs(logits[:, -1, :], temperature, top_k, top_p, min_p)
+                    tok = torch.multinomial(q, num_samples=1)
+                    draft_tokens.append(tok.item())
+                    draft_probs.append(q[0])
+                    if i < k - 1:
+                        logits, _ = draft_model(tok, kv_cache=draft_cache)
+            # 2) score the tokens not yet in the target cache plus all drafts in a single forward
+            pending = seq[target_cache.seq_len:] + draft_tokens
+            logits, _ = self(torch.tensor([pending], device=device), kv_cache=target_cache, num_logits=k + 1)
+            p = sampling.probs(logits[0], temperature, top_k, top_p, min_p) # (k+1, vocab_size)
+            # 3) accept drafts left to right, resample the first rejected one
+            m = 0
+            while m < k and torch.rand(1).item() * draft_probs[m][draft_tokens[m]] < p[m, draft_tokens[m]]:
+                m += 1
+            if m < k:
+                residual = (p[m] - draft_probs[m]).clamp(min=0)
+                p_next = residual if residual.sum() > 0 else p[m]
+            else:
+                p_next = p[k] # every draft accepted, the target's last position gives a bonus token
+            new = draft_tokens[:m] + [torch.multinomial(p_next, num_samples=1).item()]
+            # 4) roll both caches back to the accepted prefix
+            target_cache.seq_len = len(seq) + m
+            draft_cache.seq_len = min(draft_cache.seq_len, len(seq) + m)
+            stats['rounds'] += 1
+            stats['drafted'] += k
+            stats['accepted'] += m
+            for tok in new:
+                out.append(tok)
+                seq.append(tok)
+                if len(out) >= max_new_tokens or (stop is not None and ends_with_stop(out, stop)):
+                    break
+        stats['acceptance_rate'] = stats['accepted'] / max(stats['drafted'], 1)
+        stats['tokens_per_round'] = len(out) / max(stats['rounds'], 1)
+        if len(out) < max_new_tokens and not (stop is not None and ends_with_stop(out, stop)):
+            y = self.generate(torch.tensor([seq], device=device), max_new_tokens - len(out), temperature, top_k, stop=stop, top_p=top_p, min_p=min_p)
+            out += [tok for tok in y[0, len(seq):].tolist() if tok != -1]
+        return torch.cat((idx, torch.tensor([out], dtype=torch.long, device=device)), dim=1), stats
+
+def ends_with_stop(tokens, stop):
+    """
+    True if the list of token indices ends with one of the stops: a tokenizer.StopSequences, which
+    matches on the text, or token index sequences
+    """
+    if hasattr(stop, 'matches'):
+        return stop.matches(tokens)
+    return any(0 < len(s) <= len(tokens) and tokens[-len(s):] == list(s) for s in stop)
@@ -0,0 +1,168 @@
+"""
+Loads checkpoints by name and keeps the recently used ones resident, so a long-running process
+can switch between models without going back to disk.
+
+A name is an out_dir (with a ckpt.pt, ckpt_slim.bin or ckpt_<quantization>.pt in it), a GPT-2
+variant ('gpt2', ..., 'gpt2-xl'), or an alias added with register(). Resident models are kept in
+LRU order together with their encoding and, once asked for, their torch.compile'd variant.
+When the resident models exceed max_bytes the least recently used ones are evicted, and so are
+models that have not been used for max_idle seconds.
+
+>>> registry = ModelRegistry(max_bytes=2e9)
+>>> registry.register('enhanced', 'out-cybersecurity-enhanced')
+>>> entry = registry.get('enhanced') # loads from disk
+>>> entry = registry.get('enhanced') # resident, no reload
+>>> entry.model, entry.encoding, entry.compiled_model()
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import torch
+
+from model import GPTConfig, GPT
+from quantize import quantize_model, load_quantized, model_nbytes
+from checkpoint import load_slim, fingerprint
+from tokenizer import load_encoding
+
+def checkpoint_paths(out_dir, quantization=''):
+    """ the files load_checkpoint looks for in out_dir, in order of preference """
+    paths = [os.path.join(out_dir, f'ckpt_{quantization}.pt')] if quantization else []
+    return paths + [os.path.join(out_dir, 'ckpt_slim.bin'), os.path.join(out_dir, 'ckpt.pt')]
+
+def find_checkpoint(out_dir, quantization=''):
+    """ the first file load_checkpoint would look at that exists, None if out_dir has no checkpoint """
+    return next((path for path in checkpoint_paths(out_dir, quantization) if os.path.exists(path)), None)
+
+def load_checkpoint(out_dir, device='cpu', quantization=''):
+    """
+    Load the model in out_dir, returns the model and its checkpoint dict (model_args, config).
+    Looks for ckpt_<quantization>.pt converted by quantize.py, then ckpt_slim.bin exported by
+    checkpoint.py (memory-mapped), then ckpt.pt, which is quantized on the fly if asked to.
+    A converted or exported file is skipped when ckpt.pt has changed since it was written.
+    """
+    *converted, slim_path, ckpt_path = checkpoint_paths(out_dir, quantization)
+    source = fingerprint(ckpt_path) if os.path.exists(ckpt_path) else None
+    def fresh(path, checkpoint):
+        if source is None or checkpoint.get('source') == source:
+            return True
+        print(f"WARNING: {path} was not converted from the current {ckpt_path}, loading {ckpt_path} instead")
+        return False
+    for quantized_path in converted:
+        if os.path.exists(quantized_path):
+            model, checkpoint = load_quantized(quantized_path, device)
+            if fresh(quantized_path, checkpoint):
+                return model, checkpoint
+    model = None
+    if os.path.exists(slim_path):
+        model, checkpoint = load_slim(slim_path, device)
+        if not fresh(slim_path, checkpoint):
+            model = None
+    if model is None:
+        checkpoint = torch.load(ckpt_path, map_location=device)
+        # built on the meta device and materialized straight from the checkpoint tensors
+        model = GPT.meta(GPTConfig(**checkpoint['model_args'])).assign_state_dict(checkpoint['model'])
+    if quantization and not checkpoint.get('quantization'):
+        quantize_model(model, quantization)
+    return model, checkpoint
+
+@dataclass
+class ResidentModel:
+    name: str
+    model: GPT
+    encoding: object # tiktoken GPT-2 encoding or tokenizer.CompactEncoding
+    config: dict # training config of the checkpoint, e.g. the dataset
+    nbytes: int
+    last_used: float = 0.0
+    compiled: object = None
+
+    def compiled_model(self):
+        """ the torch.compile'd model, compiled on first use and kept as long as the model is resident """
+        if self.compiled is None:
+            self.compiled = torch.compile(self.model)
+        return self.compiled
+
+class ModelRegistry:
+
+    def __init__(self, max_bytes=4e9, max_idle=None, device='cpu', quantization=''):
+        self.max_bytes = max_bytes
+        self.max_idle = max_idle # seconds, None = never evict for idleness
+        self.device = device
+        self.quantization = quantization # default for names registered without one
+        self.aliases = {} # name -> (out_dir or GPT-2 variant, quantization)
+        self.resident = OrderedDict() # (source, quantization) -> ResidentModel, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def register(self, name, source, quantization=None):
+        """ make name an alias of source, an out_dir or a GPT-2 variant, optionally with its own quantization """
+        self.aliases[name] = (source, quantization)
+
+    def get(self, name):
+        """ the ResidentModel of name, loaded from disk only if it is not resident """
+        source, quantization = self.aliases.get(name, (name, None))
+        key = (source, self.quantization if quantization is None else quantization)
+        with self.lock:
+            self.evict_idle()
+            entry = self.resident.get(key)
+            if entry is None:
+                entry = self.resident[key] = self._load(name, *key)
+                self.loads += 1
+            else:
+                self.hits += 1
+            self.resident.move_to_end(key)
+            entry.last_used = time.time()
+            # make room, but never evict the model that was just asked for
+            while self.resident_bytes() > self.max_bytes and len(self.resident) > 1:
+                self._drop(next(iter(self.resident)))
+            return entry
+
+    def unload(self, name):
+        source, quantization = self.aliases.get(name, (name, None))
+        with self.lock:
+            self._drop((source, self.quantization if quantization is None else quantization))
+
+    def evict_idle(self):
+        """ drop the models that have not been used for max_idle seconds """
+        if self.max_idle is None:
+            return
+        now = time.time()
+        for key in [k for k, e in self.resident.items() if now - e.last_used > self.max_idle]:
+            self._drop(key)
+
+    def resident_bytes(self):
+        return sum(e.nbytes for e in self.resident.values())
+
+    def stats(self):
+        return dict(resident=[e.name for e in self.resident.values()], resident_bytes=self.resident_bytes(),
+                    hits=self.hits, loads=self.loads, evictions=self.evictions)
+
+    def _drop(self, key):
+        if self.resident.pop(key, None) is not None:
+            self.evictions += 1
+
+    def _load(self, name, source, quantization):
+        if source.startswith('gpt2') and not os.path.isdir(source):
+            model, config = GPT.from_pretrained(source, dict(dropout=0.0)), {}
+            if quantization:
+                quantize_model(model, quantization)
+            meta_path = None
+        else:
+            model, checkpoint = load_checkpoint(source, self.device, quantization)
+            config = checkpoint.get('config') or {}
+            # compact vocabulary if the training data was prepared with one
+            meta_path = os.path.join('data', config.get('dataset', 'processed_data'), 'meta.pkl')
+        model.eval()
+        model.to(self.device)
+        return ResidentModel(name, model, load_encoding(meta_path), config, model_nbytes(model))
+
+# the registry of the process, for scripts that just want a model by name
+default_registry = ModelRegistry()
+
+def get_model(name):
+    return default_registry.get(name)
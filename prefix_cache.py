@@ -0,0 +1,157 @@
+"""
+Cross-request prefix cache for the KV cache.
+
+The keys/values of a token only depend on the tokens before it, so requests that start with the
+same tokens (the <Q> template, a shared preamble, ...) can reuse the keys/values computed for an
+earlier request and only prefill the rest of their prompt. Cached prefixes are stored in a radix
+tree whose edges are token sequences, each node holding the keys/values of the positions on its
+edge. When the cache grows past its memory budget the least recently used leaves are evicted.
+"""
+
+import itertools
+
+import torch
+
+class _Node:
+
+    def __init__(self, tokens=(), kv=None, parent=None):
+        self.tokens = tuple(tokens) # edge label, the token indices between parent and this node
+        self.kv = kv # (2, n_layer, nh, len(tokens), hs) keys and values of those positions
+        self.parent = parent
+        self.children = {} # first token of the child's edge -> child
+        self.last_access = 0
+
+    def nbytes(self):
+        return self.kv.numel() * self.kv.element_size() if self.kv is not None else 0
+
+class PrefixCache:
+
+    def __init__(self, max_bytes=256 * 1024**2):
+        self.max_bytes = max_bytes
+        self.root = _Node()
+        self._clock = itertools.count(1)
+        # metrics
+        self.num_bytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.prompt_tokens = 0
+        self.saved_prefill_tokens = 0
+        self.evictions = 0
+
+    def load(self, tokens, kv_cache):
+        """
+        Fill the (empty, batch size 1) kv_cache with the longest cached prefix of tokens and return
+        its length, i.e. the number of tokens that no longer need to be prefilled. The last token is
+        never served from the cache since its logits are needed to sample the next token.
+        """
+        tokens = list(tokens)
+        chunks = self._match(tokens[:-1])
+        matched = sum(chunk.size(3) for chunk in chunks)
+        self.lookups += 1
+        self.prompt_tokens += len(tokens)
+        if matched > 0:
+            self.hits += 1
+            self.saved_prefill_tokens += matched
+            kv = torch.cat(chunks, dim=3) # (2, n_layer, nh, matched, hs)
+            for i in range(kv.size(1)):
+                kv_cache.update(i, kv[0, i][None], kv[1, i][None])
+            kv_cache.seq_len = matched
+        return matched
+
+    def insert(self, tokens, kv_cache):
+        """ store the keys/values of tokens, the first len(tokens) positions of row 0 of kv_cache """
+        tokens = list(tokens)
+        node, i = self.root, 0
+        now = next(self._clock)
+        while i < len(tokens):
+            node.last_access = now
+            child = node.children.get(tokens[i])
+            if child is None:
+                # nothing shares this suffix yet: hang it below node as a new leaf
+                kv = self._slice(kv_cache, i, len(tokens))
+                leaf = _Node(tokens[i:], kv, node)
+                leaf.last_access = now
+                node.children[tokens[i]] = leaf
+                self.num_bytes += leaf.nbytes()
+                break
+            n = self._common(child.tokens, tokens[i:])
+            if n < len(child.tokens):
+                child = self._split(child, n)
+            node, i = child, i + n
+        node.last_access = now
+        self._evict()
+
+    def stats(self):
+        return dict(
+            lookups=self.lookups,
+            hits=self.hits,
+            hit_rate=self.hits / max(self.lookups, 1),
+            prompt_tokens=self.prompt_tokens,
+            saved_prefill_tokens=self.saved_prefill_tokens,
+            saved_prefill_fraction=self.saved_prefill_tokens / max(self.prompt_tokens, 1),
+            num_bytes=self.num_bytes,
+            evictions=self.evictions,
+        )
+
+    def _match(self, tokens):
+        """ walk down the tree along tokens, return the kv chunks of the longest matching prefix """
+        chunks = []
+        node, i = self.root, 0
+        now = next(self._clock)
+        while i < len(tokens):
+            child = node.children.get(tokens[i])
+            if child is None:
+                break
+            child.last_access = now
+            n = self._common(child.tokens, tokens[i:])
+            chunks.append(child.kv[:, :, :, :n])
+            if n < len(child.tokens):
+                break
+            node, i = child, i + n
+        return chunks
+
+    def _split(self, node, n):
+        """ split the edge of node after n tokens, return the new inner node in between """
+        inner = _Node(node.tokens[:n], node.kv[:, :, :, :n].clone(), node.parent)
+        inner.last_access = node.last_access
+        node.parent.children[node.tokens[0]] = inner
+        node.tokens = node.tokens[n:]
+        node.kv = node.kv[:, :, :, n:].clone()
+        node.parent = inner
+        inner.children[node.tokens[0]] = node
+        return inner
+
+    def _evict(self):
+        """ drop least recently used leaves until the cache fits into max_bytes again """
+        while self.num_bytes > self.max_bytes:
+            leaves = [n for n in self._nodes() if not n.children and n is not self.root]
+            if not leaves:
+                break
+            leaf = min(leaves, key=lambda n: n.last_access)
+            del leaf.parent.children[leaf.tokens[0]]
+            self.num_bytes -= leaf.nbytes()
+            self.evictions += 1
+
+    def _nodes(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.values())
+
+    @staticmethod
+    def _slice(kv_cache, start, end):
+        # stack copies, a view would keep the whole KV cache buffer alive
+        kv = [kv_cache.get(i, start, end) for i in range(kv_cache.n_layer)]
+        k = torch.stack([k[0] for k, _ in kv])
+        v = torch.stack([v[0] for _, v in kv])
+        return torch.stack((k, v))
+
+    @staticmethod
+    def _common(a, b):
+        n = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            n += 1
+        return n
@@ -0,0 +1,151 @@
+"""
+Weight-only quantization of a trained GPT for CPU inference.
+
+int8: every nn.Linear (and the tied wte/lm_head matrix) keeps its weights as int8 with one fp32
+scale per output channel, activations stay in floating point. bf16: all weights in bfloat16.
+
+Convert a checkpoint and benchmark it against the fp32 model:
+$ python quantize.py --out_dir=out-cybersecurity-enhanced --quantization=int8
+this writes out_dir/ckpt_int8.pt, which sample.py picks up with --quantization=int8
+"""
+
+import os
+import math
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+from model import GPTConfig, GPT
+
+def quantize_per_channel(w):
+    """ symmetric int8 quantization of a 2D weight, one scale per row (output channel) """
+    scale = (w.abs().amax(dim=1).float() / 127.0).clamp(min=1e-8)
+    w_int8 = torch.round(w.float() / scale[:, None]).clamp(-128, 127).to(torch.int8)
+    return w_int8, scale
+
+class Int8Linear(nn.Module):
+    """ drop-in for nn.Linear with int8 weights and per-output-channel scales """
+
+    def __init__(self, in_features, out_features, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer('weight', torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer('scale', torch.ones(out_features))
+        self.bias = nn.Parameter(torch.zeros(out_features)) if bias else None
+
+    @classmethod
+    def from_linear(cls, linear):
+        # on the device of the weights, i.e. on the meta device for a model built by GPT.meta
+        with torch.device(linear.weight.device):
+            q = cls(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        q.weight, q.scale = quantize_per_channel(linear.weight.data)
+        if linear.bias is not None and not linear.bias.is_meta:
+            q.bias.data.copy_(linear.bias.data)
+        return q
+
+    def forward(self, x):
+        shape = x.shape
+        x = x.reshape(-1, shape[-1])
+        if hasattr(torch, '_weight_int8pack_mm') and x.device.type == 'cpu':
+            # int8 weight-only matmul kernel, the weight is never materialized in floating point
+            y = torch._weight_int8pack_mm(x, self.weight, self.scale.to(x.dtype))
+        else:
+            # x @ (W * s)^T == (x @ W^T) * s, so scale after the matmul
+            y = F.linear(x, self.weight.to(x.dtype)) * self.scale.to(x.dtype)
+        if self.bias is not None:
+            y = y + self.bias
+        return y.reshape(*shape[:-1], self.out_features)
+
+class Int8Embedding(nn.Module):
+    """ embedding lookup that shares the int8 weight and scales of the tied lm_head """
+
+    def __init__(self, lm_head):
+        super().__init__()
+        self.lm_head = [lm_head] # in a list so it is not registered (twice) as a submodule
+
+    def forward(self, idx):
+        lm_head = self.lm_head[0]
+        return lm_head.weight[idx].float() * lm_head.scale[idx][..., None]
+
+def quantize_model(model, quantization):
+    """ quantize a GPT in place, quantization is 'int8' or 'bf16' """
+    assert quantization in {'int8', 'bf16'}
+    if quantization == 'bf16':
+        return model.to(torch.bfloat16)
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.Linear):
+                setattr(module, name, Int8Linear.from_linear(child))
+    # wte was tied to the lm_head weight that has just been replaced
+    model.transformer.wte = Int8Embedding(model.lm_head)
+    return model
+
+def model_nbytes(model):
+    """ bytes held by the parameters and buffers of a model, shared tensors counted once """
+    tensors = {t.data_ptr(): t for t in list(model.parameters()) + list(model.buffers())}
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+def save_quantized(model, model_args, quantization, path, config=None, source=None):
+    checkpoint = {'model': model.state_dict(), 'model_args': model_args, 'quantization': quantization}
+    if config is not None:
+        checkpoint['config'] = config # training config, sample.py looks up the dataset's meta.pkl with it
+    if source is not None:
+        checkpoint['source'] = source # checkpoint.fingerprint() of the ckpt.pt it was converted from
+    torch.save(checkpoint, path)
+
+def load_quantized(path, device='cpu'):
+    """ load a checkpoint written by save_quantized, returns the model and the checkpoint dict """
+    checkpoint = torch.load(path, map_location=device)
+    model = quantize_model(GPT.meta(GPTConfig(**checkpoint['model_args'])), checkpoint['quantization'])
+    model.assign_state_dict(checkpoint['model'])
+    return model, checkpoint
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    out_dir = 'out'
+    quantization = 'int8' # 'int8' or 'bf16'
+    dataset = 'processed_data' # val.bin of this dataset is used for the validation loss comparison
+    eval_iters = 20 # number of val batches
+    batch_size = 4
+    max_new_tokens = 100 # tokens generated for the tokens/s measurement
+    seed = 1337
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -------------------------------------------------------------------------
+
+    from checkpoint import fingerprint
+
+    # load the fp32 model
+    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
+    checkpoint = torch.load(ckpt_path, map_location='cpu')
+    model_args = checkpoint['model_args']
+    def load_fp32():
+        # assign_state_dict does not copy, both fp32 models share the checkpoint tensors (read-only)
+        return GPT.meta(GPTConfig(**model_args)).assign_state_dict(checkpoint['model']).eval()
+
+    # convert and save
+    qmodel = quantize_model(load_fp32(), quantization).eval()
+    qpath = os.path.join(out_dir, f'ckpt_{quantization}.pt')
+    save_quantized(qmodel, model_args, quantization, qpath, checkpoint.get('config'), fingerprint(ckpt_path))
+    print(f"saved {quantization} checkpoint to {qpath}")
+
+    # benchmark: memory footprint, tokens/s and validation loss against fp32
+    data = np.memmap(os.path.join('data', dataset, 'val.bin'), dtype=np.uint16, mode='r')
+    block_size = min(model_args['block_size'], len(data) - 1)
+    rng = np.random.default_rng(seed)
+    ix = rng.integers(len(data) - block_size, size=(eval_iters, batch_size))
+    batches = [(torch.from_numpy(np.stack([data[i:i+block_size] for i in row]).astype(np.int64)),
+                torch.from_numpy(np.stack([data[i+1:i+1+block_size] for i in row]).astype(np.int64))) for row in ix]
+    prompt = batches[0][0][:1, :16]
+    for name, model in [('fp32', load_fp32()), (quantization, qmodel)]:
+        with torch.no_grad():
+            losses = [model(X, Y)[1].item() for X, Y in batches]
+            model.generate(prompt, 5) # warmup
+            t0 = time.time()
+            model.generate(prompt, max_new_tokens)
+            dt = time.time() - t0
+        print(f"{name}: {model_nbytes(model)/1e6:.2f} MB, {max_new_tokens/dt:.1f} tokens/s, "
+              f"val loss {np.mean(losses):.4f} (ppl {math.exp(np.mean(losses)):.2f})")
@@ -0,0 +1,194 @@
+"""
+Response cache in front of generation, for the canonical questions that keep coming back
+("How do I scan for open ports?", ...).
+
+Responses are keyed on the normalized prompt (unicode NFKC, whitespace collapsed),
+the model id and every sampling parameter. They are only served when the output is
+deterministic (greedy decoding, or a fixed seed) unless allow_sampled is set, in which case a
+sampled answer is replayed for repeats of the same question. Entries live in memory in LRU order
+and expire after ttl seconds; with a cache_dir they are also written to disk so they survive a
+restart. The disk tier is bounded as well: once it holds more than max_disk_entries files, put
+removes the expired ones and then the least recently used ones (a file's mtime is its creation,
+its atime is set on every hit). Every entry records the fingerprint of the checkpoint it was generated by, so the
+entries of a model become stale as soon as its checkpoint changes on disk.
+
+>>> cache = ResponseCache(ttl=24 * 3600, cache_dir='out/response_cache')
+>>> answer = cache.get('out', prompt, temperature=0.0, max_new_tokens=150)
+>>> if answer is None:
+...     answer = generate(...)
+...     cache.put('out', prompt, answer, temperature=0.0, max_new_tokens=150)
+"""
+
+import os
+import re
+import json
+import glob
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+def normalize(prompt):
+    """
+    the text two prompts must share to be answered alike. Case is kept: the model sees it, and it
+    matters in commands and code ('ls -r' is not 'ls -R')
+    """
+    prompt = unicodedata.normalize('NFKC', prompt)
+    return re.sub(r'\s+', ' ', prompt).strip()
+
+def checkpoint_fingerprint(model_id):
+    """ size and mtime of the checkpoint files of an out_dir, or the id itself for a GPT-2 variant """
+    if not os.path.isdir(model_id):
+        return model_id
+    files = sorted(glob.glob(os.path.join(model_id, 'ckpt*.pt')) + glob.glob(os.path.join(model_id, 'ckpt_slim.bin')))
+    stats = [(os.path.basename(f), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in files]
+    return hashlib.sha256(json.dumps(stats).encode()).hexdigest()[:16]
+
+class ResponseCache:
+
+    def __init__(self, max_entries=1024, ttl=3600.0, cache_dir=None, allow_sampled=False, max_disk_entries=16384):
+        self.max_entries = max_entries
+        self.ttl = ttl # seconds, None = never expire
+        self.cache_dir = cache_dir # on-disk tier, None = memory only
+        self.max_disk_entries = max_disk_entries
+        self.allow_sampled = allow_sampled # also cache answers that were sampled with temperature > 0
+        self.entries = OrderedDict() # key -> entry dict, least recently used first
+        self.lock = threading.Lock()
+        self.disk_entries = 0 # files in cache_dir, as far as this process knows
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.disk_entries = len(glob.glob(os.path.join(cache_dir, '*.json')))
+        # metrics
+        self.lookups = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def cacheable(self, temperature=1.0, seed=None, **params):
+        """ whether a request with these sampling parameters may be served from the cache """
+        return self.allow_sampled or temperature is None or temperature <= 0 or seed is not None
+
+    def get(self, model_id, prompt, **params):
+        """ the cached response of prompt, None on a miss (or if the request is not cacheable) """
+        if not self.cacheable(**params):
+            return None
+        key = self._key(model_id, prompt, params)
+        fingerprint = checkpoint_fingerprint(model_id)
+        with self.lock:
+            self.lookups += 1
+            entry, on_disk = self.entries.get(key), False
+            if entry is None and self.cache_dir is not None:
+                entry, on_disk = self._read(key), True
+            if entry is None or not self._valid(key, entry, fingerprint):
+                return None
+            self.hits += 1
+            if on_disk:
+                # promote to the memory tier
+                self.disk_hits += 1
+                self._insert(key, entry)
+            self.entries.move_to_end(key)
+            if self.cache_dir is not None:
+                self._touch(key)
+            return entry['response']
+
+    def put(self, model_id, prompt, response, **params):
+        """ store response (text or token indices), unless the request is not cacheable """
+        if not self.cacheable(**params):
+            return
+        key = self._key(model_id, prompt, params)
+        entry = dict(model=model_id, fingerprint=checkpoint_fingerprint(model_id), created=time.time(), response=response)
+        with self.lock:
+            self._insert(key, entry)
+            if self.cache_dir is not None:
+                # write then rename, a crash never leaves a half written entry behind
+                path = self._path(key)
+                self.disk_entries += not os.path.exists(path)
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(entry, f)
+                os.replace(path + '.tmp', path)
+                if self.disk_entries > self.max_disk_entries:
+                    self._prune_disk()
+
+    def invalidate(self, model_id=None):
+        """ drop the entries of model_id, or all of them, from memory and disk """
+        with self.lock:
+            for key in [k for k, e in self.entries.items() if model_id is None or e['model'] == model_id]:
+                del self.entries[key]
+                self.invalidations += 1
+            if self.cache_dir is not None:
+                for path in glob.glob(os.path.join(self.cache_dir, '*.json')):
+                    entry = self._read_path(path)
+                    if model_id is None or entry is None or entry['model'] == model_id:
+                        os.remove(path)
+                        self.disk_entries -= 1
+
+    def stats(self):
+        return dict(entries=len(self.entries), disk_entries=self.disk_entries, lookups=self.lookups, hits=self.hits, disk_hits=self.disk_hits,
+                    hit_rate=self.hits / max(self.lookups, 1), evictions=self.evictions, invalidations=self.invalidations)
+
+    def _insert(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def _key(self, model_id, prompt, params):
+        params = {k: list(v) if isinstance(v, tuple) else v for k, v in params.items()}
+        text = json.dumps([model_id, normalize(prompt), params], sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _valid(self, key, entry, fingerprint):
+        """ drop the entry if it expired or its checkpoint changed, else True """
+        expired = self.ttl is not None and time.time() - entry['created'] > self.ttl
+        if not expired and entry['fingerprint'] == fingerprint:
+            return True
+        if self.entries.pop(key, None) is not None:
+            self.invalidations += 1
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+            self.disk_entries -= 1
+        return False
+
+    def _touch(self, key):
+        """ mark the file of key as used now (atime), keeping its creation time (mtime) """
+        try:
+            os.utime(self._path(key), (time.time(), os.stat(self._path(key)).st_mtime))
+        except OSError:
+            pass # memory-only entry, or removed by another process
+
+    def _prune_disk(self):
+        """ remove expired files, then the least recently used ones, down to 90% of max_disk_entries """
+        files = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.json')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_atime, st.st_mtime, path))
+        now = time.time()
+        expired = [f for f in files if self.ttl is not None and now - f[1] > self.ttl]
+        alive = sorted(f for f in files if not (self.ttl is not None and now - f[1] > self.ttl)) # least recently used first
+        excess = max(len(alive) - int(self.max_disk_entries * 0.9), 0)
+        for _, _, path in expired + alive[:excess]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.evictions += 1
+        self.disk_entries = len(files) - len(expired) - excess
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def _read(self, key):
+        return self._read_path(self._path(key))
+
+    def _read_path(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
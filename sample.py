@@ -2,11 +2,16 @@
 Sample from a trained model
 """
 import os
+import time
 import pickle
 from contextlib import nullcontext
 import torch
 import tiktoken
-from model import GPTConfig, GPT
+import sampling
+from model import GPT
+from quantize import quantize_model
+from tokenizer import load_encoding, encode_stop_sequences
+from model_registry import load_checkpoint
 
 # -----------------------------------------------------------------------------
 init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
@@ -14,16 +19,25 @@ out_dir = 'out' # ignored if init_from is not 'resume'
 start = "\n" # or "<|endoftext|>" or etc. Can also specify a file, use as: "FILE:prompt.txt"
 num_samples = 10 # number of samples to draw
 max_new_tokens = 500 # number of tokens generated in each sample
-temperature = 0.8 # 1.0 = no change, < 1.0 = less random, > 1.0 = more random, in predictions
+temperature = 0.8 # 1.0 = no change, < 1.0 = less random, > 1.0 = more random, in predictions, 0 = greedy
 top_k = 200 # retain only the top_k most likely tokens, clamp others to have 0 probability
+legacy_top_k = False # sample top_k from the masked full vocabulary, reproduces the samples of earlier versions for a seed (slower)
+top_p = 1.0 # retain only the most likely tokens that together have probability top_p (nucleus sampling)
+min_p = 0.0 # retain only tokens with probability >= min_p * probability of the most likely token
+context_stride = 1 # past block_size, recompute the cropped context every context_stride tokens instead of every token
+stop = '' # comma separated strings that end a sample early, e.g. '</A>,<|endoftext|>'
 seed = 1337
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
 compile = False # use PyTorch 2.0 to compile the model to be faster
+draft_out_dir = '' # if set, speculative decoding with the (smaller) model in this out_dir as the draft
+num_draft_tokens = 4 # number of tokens the draft model proposes per target forward pass
+quantization = '' # '' for fp32 weights, or 'int8' / 'bf16' weight-only quantization for CPU inference, see quantize.py
 exec(open('configurator.py').read()) # overrides from command line or config file
 # -----------------------------------------------------------------------------
 
 torch.manual_seed(seed)
+sampling.FULL_VOCAB_TOP_K = legacy_top_k
 torch.cuda.manual_seed(seed)
 torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
 torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
@@ -33,25 +47,23 @@ ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=
 
 # model
 if init_from == 'resume':
-    # init from a model saved in a specific directory
-    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
-    checkpoint = torch.load(ckpt_path, map_location=device)
-    gptconf = GPTConfig(**checkpoint['model_args'])
-    model = GPT(gptconf)
-    state_dict = checkpoint['model']
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
+    # init from a model saved in a specific directory (slim / pre-quantized checkpoints preferred)
+    model, checkpoint = load_checkpoint(out_dir, device, quantization)
 elif init_from.startswith('gpt2'):
     # init from a given GPT-2 model
     model = GPT.from_pretrained(init_from, dict(dropout=0.0))
+    if quantization:
+        quantize_model(model, quantization)
 
 model.eval()
 model.to(device)
 if compile:
     model = torch.compile(model) # requires PyTorch 2.0 (optional)
+if draft_out_dir:
+    # the draft must have been trained on the same tokenizer, e.g. the fast config next to the enhanced one
+    draft_model, _ = load_checkpoint(draft_out_dir, device)
+    draft_model.eval()
+    draft_model.to(device)
 
 # look for the meta pickle in case it is available in the dataset folder
 load_meta = False
@@ -62,10 +74,17 @@ if load_meta:
     print(f"Loading meta from {meta_path}...")
     with open(meta_path, 'rb') as f:
         meta = pickle.load(f)
+if load_meta and 'stoi' in meta:
     # TODO want to make this more general to arbitrary encoder/decoder schemes
     stoi, itos = meta['stoi'], meta['itos']
+    enc = None
     encode = lambda s: [stoi[c] for c in s]
     decode = lambda l: ''.join([itos[i] for i in l])
+elif load_meta and 'vocab_remap' in meta:
+    # GPT-2 tokens restricted to the dataset's compact vocabulary
+    enc = load_encoding(meta_path)
+    encode = lambda s: enc.encode(s, allowed_special={"<|endoftext|>"})
+    decode = lambda l: enc.decode(l)
 else:
     # ok let's assume gpt-2 encodings by default
     print("No meta.pkl found, assuming GPT-2 encodings...")
@@ -78,12 +97,29 @@ if start.startswith('FILE:'):
     with open(start[5:], 'r', encoding='utf-8') as f:
         start = f.read()
 start_ids = encode(start)
-x = (torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...])
+# BPE stops are matched on the text (see tokenizer.StopSequences), characters map 1:1 to tokens
+stops = [s for s in stop.split(',') if s]
+stop_ids = None if not stops else encode_stop_sequences(enc, stops) if enc is not None else [encode(s) for s in stops]
 
 # run generation
 with torch.no_grad():
     with ctx:
-        for k in range(num_samples):
-            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k)
-            print(decode(y[0].tolist()))
-            print('---------------')
+        if draft_out_dir:
+            # speculative decoding works on one sequence at a time
+            x = (torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...])
+            for k in range(num_samples):
+                t0 = time.time()
+                y, stats = model.generate_speculative(x, draft_model, max_new_tokens, num_draft_tokens,
+                                                      temperature=temperature, top_k=top_k, stop=stop_ids, top_p=top_p, min_p=min_p)
+                dt = time.time() - t0
+                print(decode(y[0].tolist()))
+                print(f"acceptance rate {stats['acceptance_rate']*100:.1f}%, {stats['tokens_per_round']:.2f} tokens per target forward, "
+                      f"{(y.size(1) - x.size(1)) / dt:.1f} tokens/s")
+                print('---------------')
+        else:
+            # all samples together as one batch, sharing a single prefill of the prompt
+            ys = model.generate_batch([start_ids], max_new_tokens, temperature=temperature, top_k=top_k, stop=stop_ids,
+                                    top_p=top_p, min_p=min_p, num_return_sequences=num_samples, context_stride=context_stride)
+            for y in ys:
+                print(decode(start_ids + y))
+                print('---------------')
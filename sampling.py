@@ -0,0 +1,131 @@
+"""
+Batched sampling of the next token from logits of shape (b, vocab_size).
+
+Every setting is either a single value for all rows or a list with one value per row, so one call
+serves a batch that mixes requests with different settings. None (or top_p = 1, min_p = 0)
+switches a setting off.
+- temperature: <= 0 means greedy (argmax), nothing else is computed for those rows
+- top_k: keep the k most likely tokens
+- top_p: keep the smallest set of most likely tokens whose probability mass reaches p, applied
+  after top_k, to the distribution renormalized over the top_k tokens (the usual top_k -> top_p)
+- min_p: keep tokens with probability >= min_p * probability of the most likely token
+- generators: torch.Generator per row for reproducible, per-request seeded sampling
+Truncation works on the top candidates from torch.topk (a partial sort) rather than masking and
+softmaxing the full vocabulary. Candidate probabilities are still normalized over the full
+vocabulary, so the distribution is the same and top_p is exact; a row whose nucleus does not fit
+into the candidates falls back to a full sort. The draw itself is over the candidates, so a given
+seed samples differently than the masked full-vocabulary draw GPT.generate used to do; set
+FULL_VOCAB_TOP_K to get those samples back for top_k rows (at the cost of the full softmax).
+"""
+
+import torch
+from torch.nn import functional as F
+
+TOP_P_CANDIDATES = 256 # candidates considered for top_p rows that have no top_k
+FULL_VOCAB_TOP_K = False # draw rows with top_k (and no top_p) from the masked full vocabulary, like earlier versions
+
+def sample(logits, temperature=1.0, top_k=None, top_p=None, min_p=None, generators=None):
+    """ sample one index per row of logits (b, vocab_size), returns a LongTensor of shape (b, 1) """
+    b = logits.size(0)
+    temperature, top_k, top_p, min_p = _settings(b, temperature, top_k, top_p, min_p)
+    generators = _per_row(generators, b)
+    idx_next = torch.empty(b, dtype=torch.long, device=logits.device)
+    greedy = [r for r in range(b) if temperature[r] <= 0]
+    if greedy:
+        idx_next[greedy] = logits[greedy].argmax(dim=-1)
+    for rows in _groups(temperature, top_k, top_p):
+        probs, ids = _filtered_probs(logits[rows], [temperature[r] for r in rows], [top_k[r] for r in rows],
+                                     [top_p[r] for r in rows], [min_p[r] for r in rows])
+        picks = _multinomial(probs, [generators[r] for r in rows])
+        idx_next[rows] = ids.gather(1, picks[:, None]).view(-1) if ids is not None else picks
+    return idx_next[:, None]
+
+def probs(logits, temperature=1.0, top_k=None, top_p=None, min_p=None):
+    """ the full sampling distribution (b, vocab_size) that sample() draws from """
+    b, V = logits.size()
+    temperature, top_k, top_p, min_p = _settings(b, temperature, top_k, top_p, min_p)
+    out = torch.zeros(b, V, device=logits.device)
+    greedy = [r for r in range(b) if temperature[r] <= 0]
+    if greedy:
+        out[greedy, logits[greedy].argmax(dim=-1)] = 1.0
+    for rows in _groups(temperature, top_k, top_p):
+        p, ids = _filtered_probs(logits[rows], [temperature[r] for r in rows], [top_k[r] for r in rows],
+                                 [top_p[r] for r in rows], [min_p[r] for r in rows])
+        p = p / p.sum(dim=-1, keepdim=True)
+        out[rows] = p if ids is None else torch.zeros_like(out[rows]).scatter_(1, ids, p)
+    return out
+
+def _per_row(x, b):
+    if isinstance(x, (list, tuple)):
+        assert len(x) == b, f"expected one setting per row, got {len(x)} for {b} rows"
+        return list(x)
+    return [x] * b
+
+def _settings(b, temperature, top_k, top_p, min_p):
+    temperature, top_k, top_p, min_p = (_per_row(x, b) for x in (temperature, top_k, top_p, min_p))
+    top_p = [p if p is not None and p < 1.0 else None for p in top_p]
+    min_p = [m if m is not None and m > 0.0 else None for m in min_p]
+    return temperature, top_k, top_p, min_p
+
+def _groups(temperature, top_k, top_p):
+    """ the non-greedy rows, split into rows sampled from the full vocabulary and rows sampled from candidates """
+    full = [r for r, t in enumerate(temperature) if t > 0 and top_p[r] is None and (top_k[r] is None or FULL_VOCAB_TOP_K)]
+    truncated = [r for r, t in enumerate(temperature) if t > 0 and r not in full]
+    return [rows for rows in (full, truncated) if rows]
+
+def _filtered_probs(logits, temperature, top_k, top_p, min_p):
+    """
+    unnormalized probabilities after temperature, top_k, top_p and min_p, either over the full
+    vocabulary (ids is None) or over candidate token indices ids, both of shape (n, K)
+    """
+    n, V = logits.size()
+    logits = logits.float() / torch.tensor(temperature, device=logits.device)[:, None]
+    if all(p is None for p in top_p) and (FULL_VOCAB_TOP_K or all(k is None for k in top_k)):
+        # softmax over the full vocabulary, optionally cropped to the top k options
+        if any(k is not None for k in top_k):
+            v, _ = torch.topk(logits, min(max(k for k in top_k if k is not None), V))
+            kth = v.gather(1, torch.tensor([min(k, V) - 1 if k is not None else 0 for k in top_k], device=logits.device)[:, None])
+            kth[[r for r, k in enumerate(top_k) if k is None]] = -float('Inf')
+            logits[logits < kth] = -float('Inf')
+        probs = F.softmax(logits, dim=-1)
+        if any(m is not None for m in min_p):
+            mp = torch.tensor([m if m is not None else 0.0 for m in min_p], device=logits.device)
+            probs = probs.masked_fill(probs < mp[:, None] * probs.amax(dim=-1, keepdim=True), 0.0)
+        return probs, None
+    return _truncated_probs(logits, top_k, top_p, min_p, TOP_P_CANDIDATES)
+
+def _truncated_probs(logits, top_k, top_p, min_p, num_candidates):
+    n, V = logits.size()
+    device = logits.device
+    K = min(max(k if k is not None else num_candidates for k in top_k), V)
+    vals, ids = torch.topk(logits, K, dim=-1) # sorted, most likely first
+    probs = (vals - logits.logsumexp(dim=-1, keepdim=True)).exp() # probabilities over the full vocabulary
+    keep = torch.arange(K, device=device)[None, :] < torch.tensor([k if k is not None else K for k in top_k], device=device)[:, None]
+    if any(p is not None for p in top_p):
+        pp = torch.tensor([p if p is not None else 1.0 for p in top_p], device=device)
+        # top_p is relative to the mass left after top_k, or to the full vocabulary without top_k
+        no_k = torch.tensor([k is None for k in top_k], device=device)
+        q = probs * keep
+        q = q / torch.where(no_k, torch.ones_like(pp), q.sum(dim=-1))[:, None]
+        cum = q.cumsum(dim=-1)
+        # a row that is only limited by top_p but whose nucleus is not within the candidates
+        if K < V and ((cum[:, -1] < pp) & no_k).any():
+            return _truncated_probs(logits, top_k, top_p, min_p, V)
+        keep &= (cum - q) < pp[:, None] # the most likely token is always kept
+    if any(m is not None for m in min_p):
+        mp = torch.tensor([m if m is not None else 0.0 for m in min_p], device=device)
+        keep &= probs >= mp[:, None] * probs[:, :1]
+    return probs * keep, ids
+
+def _multinomial(probs, generators):
+    """ draw one index per row of (unnormalized) probs, rows with a generator draw from it """
+    if all(g is None for g in generators):
+        return torch.multinomial(probs, num_samples=1).view(-1)
+    picks = torch.empty(probs.size(0), dtype=torch.long, device=probs.device)
+    shared = [r for r, g in enumerate(generators) if g is None]
+    if shared:
+        picks[shared] = torch.multinomial(probs[shared], num_samples=1).view(-1)
+    for r, g in enumerate(generators):
+        if g is not None:
+            picks[r] = torch.multinomial(probs[r], num_samples=1, generator=g)[0]
+    return picks
@@ -0,0 +1,198 @@
+"""
+Semantic answer cache: serves the cached answer of a paraphrase ("scan open ports" vs "find open
+ports") that exact-match caching (response_cache.py) misses.
+
+Questions are embedded with GPT.embed (pooled ln_f hidden states, L2-normalized) and a new
+question is answered from the cache when the cosine similarity of its nearest cached question
+passes threshold. The embeddings of a model are not comparable with those of another
+checkpoint, so a cache belongs to one model (and one set of sampling settings).
+
+Small caches are searched brute force with one matrix-vector product. Past ivf_min entries the
+index switches to an inverted file (IVF): the embeddings are clustered with spherical k-means
+into about sqrt(n) lists, each stored contiguously, and a query only scans the nprobe lists
+whose centroids are closest, which keeps a lookup well under a millisecond at 100k entries (see the benchmark at the bottom,
+python semantic_cache.py). The clustering is redone each time the cache doubled in size. Once
+max_entries is reached the oldest entries are overwritten.
+"""
+
+import time
+
+import numpy as np
+
+def kmeans(x, k, iters=10, seed=0):
+    """ spherical k-means of the unit rows of x, returns the (k, d) unit centroids """
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)]
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = ~sums.any(axis=1)
+        sums[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)] # restart empty clusters
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+    return centroids
+
+class VectorIndex:
+    """ nearest neighbours by cosine similarity among unit vectors, brute force or IVF """
+
+    def __init__(self, dim, max_entries=100_000, ivf_min=8192, nprobe=8):
+        self.max_entries = max_entries
+        self.ivf_min = ivf_min # entries at which the index switches from brute force to IVF
+        self.nprobe = nprobe # IVF lists scanned per query
+        self.vectors = np.zeros((max_entries, dim), dtype=np.float32)
+        self.count = 0 # entries ever added, entry i lives in slot i % max_entries
+        self.centroids = None
+        self.lists = None # per centroid [vectors (capacity, d), slots (capacity,), size], kept contiguous
+        self.list_of = np.zeros(max_entries, dtype=np.int64) # slot -> its list
+        self.pos_of = np.zeros(max_entries, dtype=np.int64) # slot -> its position in its list
+        self.trained_at = 0
+
+    def __len__(self):
+        return min(self.count, self.max_entries)
+
+    def add(self, vectors):
+        """ add the (n, d) unit vectors, returns their slots """
+        slots = []
+        for v in np.asarray(vectors, dtype=np.float32):
+            slot = self.count % self.max_entries
+            if self.lists is not None and self.count >= self.max_entries:
+                self._remove(slot) # overwrite the oldest entry
+            self.vectors[slot] = v
+            self.count += 1
+            if self.lists is not None:
+                self._append(int(np.argmax(self.centroids @ v)), slot)
+            slots.append(slot)
+        if len(self) >= self.ivf_min and len(self) >= 2 * self.trained_at:
+            self.train()
+        return slots
+
+    def train(self):
+        """ (re)cluster the entries into about sqrt(n) IVF lists """
+        n = len(self)
+        k = int(np.sqrt(n))
+        rng = np.random.default_rng(n)
+        sample = self.vectors[rng.choice(n, min(n, 32 * k), replace=False)]
+        self.centroids = kmeans(sample, k)
+        # assign in chunks to bound the (chunk, k) similarity matrix
+        for start in range(0, n, 16384):
+            self.list_of[start:min(n, start + 16384)] = np.argmax(self.vectors[start:min(n, start + 16384)] @ self.centroids.T, axis=1)
+        self.lists = []
+        for c in range(k):
+            slots = np.flatnonzero(self.list_of[:n] == c)
+            self.pos_of[slots] = np.arange(len(slots))
+            self.lists.append([self.vectors[slots], slots, len(slots)])
+        self.trained_at = n
+
+    def _append(self, c, slot):
+        lst = self.lists[c]
+        vecs, slots, size = lst
+        if size == len(slots):
+            # grow the list by doubling its capacity
+            lst[0] = vecs = np.concatenate([vecs, np.zeros((max(size, 8), vecs.shape[1]), dtype=np.float32)])
+            lst[1] = slots = np.concatenate([slots, np.zeros(max(size, 8), dtype=np.int64)])
+        vecs[size], slots[size] = self.vectors[slot], slot
+        self.list_of[slot], self.pos_of[slot] = c, size
+        lst[2] = size + 1
+
+    def _remove(self, slot):
+        # move the last entry of the list into the hole
+        lst = self.lists[self.list_of[slot]]
+        vecs, slots, size = lst
+        pos, last = self.pos_of[slot], size - 1
+        vecs[pos], slots[pos] = vecs[last], slots[last]
+        self.pos_of[slots[pos]] = pos
+        lst[2] = last
+
+    def search(self, v):
+        """ the slot of the nearest entry to unit vector v and its cosine similarity, (-1, -1.0) if empty """
+        if len(self) == 0:
+            return -1, -1.0
+        if self.lists is None:
+            sims = self.vectors[:len(self)] @ v
+            best = int(np.argmax(sims))
+            return best, float(sims[best])
+        probe = np.argpartition(-(self.centroids @ v), min(self.nprobe, len(self.lists) - 1))[:self.nprobe]
+        best, best_sim = -1, -1.0
+        for c in probe.tolist():
+            vecs, slots, size = self.lists[c]
+            if size == 0:
+                continue
+            sims = vecs[:size] @ v
+            i = int(np.argmax(sims))
+            if sims[i] > best_sim:
+                best, best_sim = int(slots[i]), float(sims[i])
+        return best, best_sim
+
+class SemanticCache:
+
+    def __init__(self, model, encoding, threshold=0.95, max_entries=100_000, ivf_min=8192, nprobe=8, pooling='mean'):
+        self.model = model
+        self.encoding = encoding
+        self.threshold = threshold # cosine similarity needed to serve a cached answer
+        self.pooling = pooling # see GPT.embed
+        self.index = VectorIndex(model.config.n_embd, max_entries, ivf_min, nprobe)
+        self.questions = [None] * max_entries # slot -> question
+        self.answers = [None] * max_entries # slot -> answer
+        # metrics
+        self.lookups = 0
+        self.hits = 0
+        self.search_time = 0.0 # seconds spent in the index, not counting the embedding forward
+
+    def embed(self, questions):
+        """ (n, n_embd) float32 unit embeddings of a list of question strings """
+        prompts = [self.encoding.encode(q, allowed_special={"<|endoftext|>"}) for q in questions]
+        return self.model.embed(prompts, self.pooling).cpu().numpy()
+
+    def add(self, questions, answers):
+        """ cache the answers of a list of questions """
+        for slot, q, a in zip(self.index.add(self.embed(questions)), questions, answers):
+            self.questions[slot], self.answers[slot] = q, a
+
+    def lookup(self, question):
+        """ (answer, cached question, similarity) of the nearest cached question, None below threshold """
+        return self.lookup_embedding(self.embed([question])[0])
+
+    def lookup_embedding(self, v):
+        """ as lookup(), for a question already embedded with embed() """
+        t0 = time.perf_counter()
+        slot, sim = self.index.search(v)
+        self.search_time += time.perf_counter() - t0
+        self.lookups += 1
+        if slot < 0 or sim < self.threshold:
+            return None
+        self.hits += 1
+        return self.answers[slot], self.questions[slot], sim
+
+    def stats(self):
+        return dict(entries=len(self.index), lookups=self.lookups, hits=self.hits, hit_rate=self.hits / max(self.lookups, 1),
+                    ivf_lists=len(self.index.lists) if self.index.lists is not None else 0,
+                    search_us=1e6 * self.search_time / max(self.lookups, 1))
+
+# -----------------------------------------------------------------------------
+# benchmark: index lookup latency vs number of cached entries, brute force and IVF
+if __name__ == '__main__':
+    dim = 384 # n_embd of train_cybersecurity_enhanced
+    sizes = (1000, 10000, 100000)
+    num_queries = 1000
+    nprobe = 8
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    rng = np.random.default_rng(1337)
+    unit = lambda x: (x / np.linalg.norm(x, axis=-1, keepdims=True)).astype(np.float32)
+    for n in sizes:
+        # clustered data (questions come in topics), queries are perturbed entries
+        topics = unit(rng.standard_normal((max(n // 100, 1), dim)))
+        data = unit(topics[rng.integers(len(topics), size=n)] + 0.5 * unit(rng.standard_normal((n, dim))))
+        picked = rng.integers(n, size=num_queries)
+        queries = unit(data[picked] + 0.1 * unit(rng.standard_normal((num_queries, dim))))
+        for name, ivf_min in (('brute force', n + 1), ('ivf', 1)):
+            index = VectorIndex(dim, max_entries=n, ivf_min=min(ivf_min, n + 1), nprobe=nprobe)
+            t0 = time.perf_counter()
+            index.add(data)
+            build = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            found = [index.search(q)[0] for q in queries]
+            dt = (time.perf_counter() - t0) / num_queries
+            recall = np.mean(np.array(found) == picked)
+            print(f"{n:7d} entries {name:11s}: {dt*1e6:8.1f} us/lookup, recall@1 {recall:.3f}, build {build:.2f}s")
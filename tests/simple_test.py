@@ -3,47 +3,27 @@
 Simple test to demonstrate the training with high-quality questions
 """
 
-import os
-import pickle
-from contextlib import nullcontext
 import torch
-import tiktoken
-from model import GPTConfig, GPT
+from tokenizer import encode_stop_sequences
+from model_registry import get_model, find_checkpoint
 
 def simple_test():
     """Simple test of the model"""
     
     # Load the model
     model_dir = 'models'
-    ckpt_path = os.path.join(model_dir, 'ckpt.pt')
+    ckpt_path = find_checkpoint(model_dir) # ckpt.pt, or a slim / quantized export of it
     
-    if not os.path.exists(ckpt_path):
+    if ckpt_path is None:
         print("No trained model found. Please wait for training to complete.")
         return
     
     print(f"Loading model from {ckpt_path}")
     
-    # Load checkpoint
+    # Load through the model registry: slim / meta-device loading, and no reload while it stays resident
     device = 'cpu'
-    checkpoint = torch.load(ckpt_path, map_location=device)
-    
-    # Create model
-    gptconf = GPTConfig(**checkpoint['model_args'])
-    model = GPT(gptconf)
-    
-    # Load state dict
-    state_dict = checkpoint['model']
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
-    
-    model.eval()
-    model.to(device)
-    
-    # Load encoder
-    enc = tiktoken.get_encoding("gpt2")
+    entry = get_model(model_dir)
+    model, enc = entry.model, entry.encoding
     
     print(f"Model loaded! Parameters: {sum(p.numel() for p in model.parameters())/1e6:.2f}M")
     
@@ -69,7 +49,7 @@ def simple_test():
         
         # Generate
         with torch.no_grad():
-            y = model.generate(x, 100, temperature=0.6, top_k=50)
+            y = model.generate(x, 100, temperature=0.6, top_k=50, stop=encode_stop_sequences(enc))
             response = enc.decode(y[0].tolist())
         
         # Extract answer
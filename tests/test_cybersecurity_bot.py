@@ -4,45 +4,29 @@ Test script for the cybersecurity chatbot
 """
 
 import os
-import pickle
 from contextlib import nullcontext
 import torch
-import tiktoken
-from model import GPTConfig, GPT
+from tokenizer import encode_stop_sequences
+from chat import format_prompt, stream_response
+from model_registry import get_model, find_checkpoint
+from response_cache import ResponseCache
 
 def load_model(model_dir='models'):
     """Load the trained cybersecurity model"""
     
-    # Check if model exists
-    ckpt_path = os.path.join(model_dir, 'ckpt.pt')
-    if not os.path.exists(ckpt_path):
-        print(f"No model checkpoint found at {ckpt_path}")
+    # Check if model exists (ckpt.pt, or a slim / quantized export of it)
+    ckpt_path = find_checkpoint(model_dir)
+    if ckpt_path is None:
+        print(f"No model checkpoint found in {model_dir}")
         print("Please train the model first using: python train.py config/train_cybersecurity.py")
         return None, None, None
     
     print(f"Loading model from {ckpt_path}")
     
-    # Load checkpoint
+    # Load through the model registry: slim / meta-device loading, and no reload while it stays resident
     device = 'cpu'  # Always use CPU for inference
-    checkpoint = torch.load(ckpt_path, map_location=device)
-    
-    # Create model
-    gptconf = GPTConfig(**checkpoint['model_args'])
-    model = GPT(gptconf)
-    
-    # Load state dict
-    state_dict = checkpoint['model']
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
-    
-    model.eval()
-    model.to(device)
-    
-    # Load encoder
-    enc = tiktoken.get_encoding("gpt2")
+    entry = get_model(model_dir)
+    model, enc = entry.model, entry.encoding
     
     print(f"Model loaded successfully!")
     print(f"Model parameters: {sum(p.numel() for p in model.parameters())/1e6:.2f}M")
@@ -60,11 +44,24 @@ def generate_response(model, encoder, device, prompt, max_new_tokens=100, temper
     ctx = nullcontext()
     with torch.no_grad():
         with ctx:
-            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=50)
+            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=50, stop=encode_stop_sequences(encoder))
             response = encoder.decode(y[0].tolist())
             
     return response
 
+def generate_responses(model, encoder, prompts, max_new_tokens=100, temperature=0.8):
+    """Generate responses for several prompts in one batched run"""
+    
+    # Encode prompts
+    prompt_ids = [encoder.encode(p, allowed_special={"<|endoftext|>"}) for p in prompts]
+    
+    # Generate all rows together, each row stops on its own once its answer is closed
+    with torch.no_grad():
+        completions = model.generate_batch(prompt_ids, max_new_tokens, temperature=temperature, top_k=50,
+                                           stop=encode_stop_sequences(encoder))
+    
+    return [p + encoder.decode(c) for p, c in zip(prompts, completions)]
+
 def interactive_chat():
     """Interactive chat with the cybersecurity bot"""
     
@@ -74,6 +71,11 @@ def interactive_chat():
     if model is None:
         return
     
+    # Repeated questions get the earlier answer back, also after a restart, until the checkpoint changes
+    model_dir = 'models'
+    cache = ResponseCache(ttl=24 * 3600, cache_dir=os.path.join(model_dir, 'response_cache'), allow_sampled=True)
+    params = dict(max_new_tokens=150, temperature=0.7, top_k=50)
+    
     print("\n" + "="*50)
     print("CYBERSECURITY CHATBOT")
     print("="*50)
@@ -93,23 +95,18 @@ def interactive_chat():
             if not user_input:
                 continue
             
-            # Format input if not already formatted
-            if not user_input.startswith('<Q>'):
-                user_input = f"<Q>{user_input}</Q>\n<A>"
+            # Format input if not already formatted, <Q>...</Q> typed by the user still gets its <A>
+            user_input = format_prompt(user_input)
             
             print("Bot: ", end="", flush=True)
             
-            # Generate response
-            response = generate_response(model, encoder, device, user_input, max_new_tokens=150, temperature=0.7)
-            
-            # Extract just the answer part
-            if '<A>' in response:
-                answer_part = response.split('<A>')[-1]
-                if '</A>' in answer_part:
-                    answer_part = answer_part.split('</A>')[0]
-                print(answer_part.strip())
+            answer = cache.get(model_dir, user_input, **params)
+            if answer is not None:
+                print(answer)
             else:
-                print(response[len(user_input):].strip())
+                # Stream the answer as it is generated
+                answer = stream_response(model, encoder, device, user_input, max_new_tokens=150, temperature=0.7)
+                cache.put(model_dir, user_input, answer, **params)
             
             print()
             
@@ -137,17 +134,17 @@ def test_examples():
         "<Q>How do I escalate privileges in Linux?</Q>\n<A>"
     ]
     
+    responses = generate_responses(model, encoder, examples, max_new_tokens=100, temperature=0.5)
+    
     print("\n" + "="*50)
     print("TESTING CYBERSECURITY CHATBOT")
     print("="*50)
     
-    for i, example in enumerate(examples, 1):
+    for i, (example, response) in enumerate(zip(examples, responses), 1):
         print(f"\nTest {i}:")
         print(f"Question: {example.split('</Q>')[0].replace('<Q>', '')}")
         print("Answer: ", end="", flush=True)
         
-        response = generate_response(model, encoder, device, example, max_new_tokens=100, temperature=0.5)
-        
         # Extract answer
         if '<A>' in response:
             answer_part = response.split('<A>')[-1]
@@ -0,0 +1,84 @@
+"""
+The fast generation paths produce what a plain forward pass over the whole sequence produces
+"""
+
+import torch
+
+from model import GPTConfig, GPT, KVCache, KVBlockPool, PagedKVCache
+from engine import InferenceEngine, Request
+from export import export_model
+from aot_runtime import AOTModel
+
+def tiny_model(block_size=32):
+    torch.manual_seed(0)
+    return GPT(GPTConfig(n_layer=2, n_head=2, n_embd=32, block_size=block_size, bias=False, vocab_size=50, dropout=0.0)).eval()
+
+def prompts():
+    g = torch.Generator().manual_seed(1)
+    return [torch.randint(50, (n,), generator=g).tolist() for n in (5, 12, 1, 20)]
+
+def greedy_recompute(model, prompt, max_new_tokens):
+    """ reference decoding: the full (cropped) context is forwarded for every token, no cache """
+    seq = list(prompt)
+    with torch.no_grad():
+        for _ in range(max_new_tokens):
+            logits, _ = model(torch.tensor([seq[-model.config.block_size:]]))
+            seq.append(logits[0, -1].argmax().item())
+    return seq[len(prompt):]
+
+def test_cached_generate_matches_recompute():
+    model = tiny_model()
+    for prompt in prompts():
+        # 20 + 24 tokens also runs past block_size, where the window is recomputed
+        y = model.generate(torch.tensor([prompt]), 24, temperature=0)
+        assert y[0, len(prompt):].tolist() == greedy_recompute(model, prompt, 24)
+
+def test_generate_batch_matches_generate():
+    model = tiny_model()
+    out = model.generate_batch(prompts(), [24, 10, 3, 15], temperature=0)
+    for prompt, tokens in zip(prompts(), out):
+        assert tokens == model.generate(torch.tensor([prompt]), len(tokens), temperature=0)[0, len(prompt):].tolist()
+
+def test_paged_kv_cache_matches_kv_cache():
+    model = tiny_model()
+    caches = [KVCache(model.config), PagedKVCache(KVBlockPool(model.config, num_blocks=32, tokens_per_block=4))]
+    idx, pad = GPT._left_pad(prompts(), 'cpu')
+    with torch.no_grad():
+        for cache in caches:
+            cache.pad = pad
+        logits = [model(idx, kv_cache=cache)[0] for cache in caches]
+        assert torch.allclose(logits[0], logits[1], atol=1e-5)
+        for step in range(6):
+            if step == 3:
+                rows = torch.tensor([0, 2, 3]) # a finished row leaves the batch
+                for cache in caches:
+                    cache.select(rows)
+                logits = [l[rows] for l in logits]
+            idx_next = logits[0][:, -1].argmax(dim=-1, keepdim=True)
+            logits = [model(idx_next, kv_cache=cache)[0] for cache in caches]
+            assert torch.allclose(logits[0], logits[1], atol=1e-5)
+
+def test_engine_matches_generate():
+    model = tiny_model()
+    expected = [greedy_recompute(model, p, min(10, model.config.block_size - len(p))) for p in prompts()]
+    for kv_pool in (None, KVBlockPool(model.config, num_blocks=64, tokens_per_block=4)):
+        engine = InferenceEngine(model, kv_pool=kv_pool)
+        done = engine.generate([Request(p, max_new_tokens=10, temperature=0) for p in prompts()])
+        assert [r.output for r in done] == expected
+
+def test_doc_ids_match_separate_documents():
+    model = tiny_model()
+    docs = prompts()[:3]
+    idx = torch.tensor([sum(docs, [])])
+    doc_ids = torch.tensor([[d for d, doc in enumerate(docs) for _ in doc]])
+    with torch.no_grad():
+        packed, _ = model(idx, idx, doc_ids=doc_ids) # targets only to get the logits of every position
+        separate = torch.cat([model(torch.tensor([doc]), torch.tensor([doc]))[0] for doc in docs], dim=1)
+    assert torch.allclose(packed, separate, atol=1e-5)
+
+def test_export_matches_eager(tmp_path):
+    model = tiny_model()
+    export_model(model, tmp_path, aoti=False)
+    aot = AOTModel(tmp_path)
+    for prompt in prompts():
+        assert aot.generate(prompt, 24, temperature=0) == greedy_recompute(model, prompt, 24)
@@ -0,0 +1,43 @@
+"""
+int8 checkpoints load back into the same model, also for models with biases
+"""
+
+import os
+
+import torch
+
+from model import GPTConfig, GPT
+from quantize import quantize_model, save_quantized, load_quantized
+from checkpoint import save_slim, load_slim, fingerprint
+from model_registry import load_checkpoint
+
+def test_int8_bias_round_trip(tmp_path):
+    torch.manual_seed(0)
+    model_args = dict(n_layer=2, n_head=2, n_embd=32, block_size=16, bias=True, vocab_size=64, dropout=0.0)
+    model = GPT(GPTConfig(**model_args))
+    for module in model.modules():
+        if isinstance(module, torch.nn.Linear) and module.bias is not None:
+            torch.nn.init.normal_(module.bias, std=0.1) # biases are initialized to zero
+    qmodel = quantize_model(model, 'int8').eval()
+    idx = torch.randint(64, (2, 16))
+    with torch.no_grad():
+        expected, _ = qmodel(idx)
+
+    save_quantized(qmodel, model_args, 'int8', tmp_path / 'ckpt_int8.pt')
+    save_slim(qmodel, model_args, tmp_path / 'ckpt_slim.bin', quantization='int8')
+    for loaded, _ in (load_quantized(tmp_path / 'ckpt_int8.pt'), load_slim(tmp_path / 'ckpt_slim.bin')):
+        with torch.no_grad():
+            logits, _ = loaded.eval()(idx)
+        assert torch.equal(logits, expected)
+
+def test_stale_converted_checkpoint(tmp_path):
+    model_args = dict(n_layer=1, n_head=2, n_embd=16, block_size=8, bias=False, vocab_size=32, dropout=0.0)
+    model = GPT(GPTConfig(**model_args))
+    ckpt_path = tmp_path / 'ckpt.pt'
+    torch.save({'model': model.state_dict(), 'model_args': model_args}, ckpt_path)
+    save_slim(model, model_args, tmp_path / 'ckpt_slim.bin', source=fingerprint(ckpt_path))
+    assert 'tensors' in load_checkpoint(tmp_path)[1] # the slim header
+    # training wrote a new ckpt.pt after the export
+    stat = os.stat(ckpt_path)
+    os.utime(ckpt_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert 'tensors' not in load_checkpoint(tmp_path)[1]
@@ -0,0 +1,39 @@
+"""
+Stop sequences are matched on the text of the generated tokens
+"""
+
+import pickle
+
+import tiktoken
+
+from model import ends_with_stop
+from tokenizer import StopSequences, encode_stop_sequences
+
+GPT2_PATTERN = r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+
+def small_bpe():
+    """ byte-level BPE with GPT-2's pre-tokenizer and the merges that glue '</' to the punctuation before it """
+    ranks = {bytes([b]): b for b in range(256)}
+    for merge in (b'</', b'.</', b'></', b'scan'):
+        ranks[merge] = len(ranks)
+    return tiktoken.Encoding('small-bpe', pat_str=GPT2_PATTERN, mergeable_ranks=ranks,
+                             special_tokens={'<|endoftext|>': len(ranks)})
+
+def test_stop_after_punctuation():
+    enc = small_bpe()
+    stop = encode_stop_sequences(enc)
+    tokens = enc.encode('<A>nmap -sV scan.</A>')
+    # '.</' 'A' '>': the tokens of '</A>' on its own do not appear
+    assert enc.encode('</A>') != tokens[-3:]
+    assert not ends_with_stop(tokens, enc.encode_batch(['</A>']))
+    assert ends_with_stop(tokens, stop)
+    assert ends_with_stop(enc.encode('<CMD>ls</CMD></A>'), stop)
+    assert ends_with_stop(enc.encode('<A>yes </A>'), stop)
+    assert ends_with_stop(enc.encode('done') + [enc.eot_token], stop)
+    assert not ends_with_stop(enc.encode('<A>scan.</A'), stop)
+    assert not ends_with_stop(enc.encode('</A> and more'), stop)
+
+def test_stop_sequences_pickle():
+    enc = small_bpe()
+    stop = pickle.loads(pickle.dumps(StopSequences(enc, ['</A>'])))
+    assert stop.matches(enc.encode('scan.</A>'))
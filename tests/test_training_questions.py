@@ -4,50 +4,32 @@ Test script specifically for the high-quality training questions
 Loads and tests the model with sample questions from train_questions.txt
 """
 
-import os
-import pickle
 from contextlib import nullcontext
 import torch
-import tiktoken
-from model import GPTConfig, GPT
+from tokenizer import encode_stop_sequences
+from chat import stream_response
+from model_registry import get_model, find_checkpoint
 
 def load_model(model_dir='models'):
     """Load the trained cybersecurity model"""
     
-    # Check if model exists, fallback to fast model if enhanced not ready
-    ckpt_path = os.path.join(model_dir, 'ckpt.pt')
-    if not os.path.exists(ckpt_path):
-        print(f"Enhanced model not found at {ckpt_path}")
+    # Check if model exists (ckpt.pt, or a slim / quantized export of it), fallback to fast model if enhanced not ready
+    ckpt_path = find_checkpoint(model_dir)
+    if ckpt_path is None:
+        print(f"Enhanced model not found in {model_dir}")
         model_dir = 'models'
-        ckpt_path = os.path.join(model_dir, 'ckpt.pt')
-        if not os.path.exists(ckpt_path):
-            print(f"No model checkpoint found at {ckpt_path}")
+        ckpt_path = find_checkpoint(model_dir)
+        if ckpt_path is None:
+            print(f"No model checkpoint found in {model_dir}")
             print("Please train the model first.")
             return None, None, None
     
     print(f"Loading model from {ckpt_path}")
     
-    # Load checkpoint
+    # Load through the model registry: slim / meta-device loading, and no reload while it stays resident
     device = 'cpu'
-    checkpoint = torch.load(ckpt_path, map_location=device)
-    
-    # Create model
-    gptconf = GPTConfig(**checkpoint['model_args'])
-    model = GPT(gptconf)
-    
-    # Load state dict
-    state_dict = checkpoint['model']
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
-    
-    model.eval()
-    model.to(device)
-    
-    # Load encoder
-    enc = tiktoken.get_encoding("gpt2")
+    entry = get_model(model_dir)
+    model, enc = entry.model, entry.encoding
     
     print(f"Model loaded successfully from {model_dir}!")
     print(f"Model parameters: {sum(p.numel() for p in model.parameters())/1e6:.2f}M")
@@ -65,11 +47,24 @@ def generate_response(model, encoder, device, prompt, max_new_tokens=150, temper
     ctx = nullcontext()
     with torch.no_grad():
         with ctx:
-            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=50)
+            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=50, stop=encode_stop_sequences(encoder))
             response = encoder.decode(y[0].tolist())
             
     return response
 
+def generate_responses(model, encoder, prompts, max_new_tokens=150, temperature=0.7):
+    """Generate responses for several prompts in one batched run"""
+    
+    # Encode prompts
+    prompt_ids = [encoder.encode(p, allowed_special={"<|endoftext|>"}) for p in prompts]
+    
+    # Generate all rows together, each row stops on its own once its answer is closed
+    with torch.no_grad():
+        completions = model.generate_batch(prompt_ids, max_new_tokens, temperature=temperature, top_k=50,
+                                           stop=encode_stop_sequences(encoder))
+    
+    return [p + encoder.decode(c) for p, c in zip(prompts, completions)]
+
 def test_training_questions():
     """Test with the high-quality training questions"""
     
@@ -92,20 +87,19 @@ def test_training_questions():
         "How do I make the bot provide remediation recommendations rather than exploitation steps?"
     ]
     
+    # Format questions with special tokens and answer them all in one batch
+    formatted_questions = [f"<Q>{question}</Q>\n<A>" for question in test_questions]
+    responses = generate_responses(model, encoder, formatted_questions, max_new_tokens=200, temperature=0.6)
+    
     print("\n" + "="*70)
     print("TESTING CYBERSECURITY CHATBOT WITH HIGH-QUALITY QUESTIONS")
     print("="*70)
     
-    for i, question in enumerate(test_questions, 1):
+    for i, (question, formatted_question, response) in enumerate(zip(test_questions, formatted_questions, responses), 1):
         print(f"\nTest {i}/{ len(test_questions)}:")
         print(f"Question: {question}")
         print("Answer: ", end="", flush=True)
         
-        # Format question with special tokens
-        formatted_question = f"<Q>{question}</Q>\n<A>"
-        
-        response = generate_response(model, encoder, device, formatted_question, max_new_tokens=200, temperature=0.6)
-        
         # Extract answer
         if '<A>' in response:
             answer_part = response.split('<A>')[-1]
@@ -150,17 +144,8 @@ def interactive_training_questions():
             
             print("Bot: ", end="", flush=True)
             
-            # Generate response
-            response = generate_response(model, encoder, device, formatted_question, max_new_tokens=200, temperature=0.7)
-            
-            # Extract answer
-            if '<A>' in response:
-                answer_part = response.split('<A>')[-1]
-                if '</A>' in answer_part:
-                    answer_part = answer_part.split('</A>')[0]
-                print(answer_part.strip())
-            else:
-                print(response[len(formatted_question):].strip())
+            # Stream the answer as it is generated
+            stream_response(model, encoder, device, formatted_question, max_new_tokens=200, temperature=0.7)
             
             print()
             
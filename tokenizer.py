@@ -0,0 +1,125 @@
+"""
+Helpers around the tiktoken GPT-2 encoding used by the model.
+"""
+
+import os
+import codecs
+import functools
+import pickle
+
+import tiktoken
+
+def load_encoding(meta_path=None):
+    """
+    The encoding a model was trained with: a CompactEncoding if the dataset's meta.pkl holds a
+    vocab_remap (see data/prepare_cybersecurity.py --compact-vocab), the GPT-2 encoding otherwise.
+    """
+    enc = tiktoken.get_encoding("gpt2")
+    if meta_path is not None and os.path.exists(meta_path):
+        with open(meta_path, 'rb') as f:
+            meta = pickle.load(f)
+        if 'vocab_remap' in meta:
+            return CompactEncoding(enc, meta['vocab_remap'])
+    return enc
+
+class CompactEncoding:
+    """
+    The GPT-2 encoding restricted to the token ids that occur in the training corpus, so the
+    model's wte / lm_head only need len(vocab) rows. vocab lists the GPT-2 id of every compact id.
+    It always contains the 256 single byte tokens, so text with GPT-2 tokens outside of the
+    corpus still encodes: such a token is spelled out as its bytes. Drop-in for the tiktoken
+    encoding in encode_stop_sequences, IncrementalDetokenizer, and the encode / decode calls.
+    """
+
+    def __init__(self, enc, vocab):
+        self.enc = enc
+        self.vocab = list(vocab)
+        self.compact_ids = {t: i for i, t in enumerate(self.vocab)}
+        self.n_vocab = len(self.vocab)
+        self.eot_token = self.compact_ids.get(enc.eot_token)
+
+    def encode(self, text, **kwargs):
+        return self.to_compact(self.enc.encode(text, **kwargs))
+
+    def decode(self, tokens):
+        return self.enc.decode(self.to_gpt2(tokens))
+
+    def decode_single_token_bytes(self, token):
+        return self.enc.decode_single_token_bytes(self.vocab[token])
+
+    def to_compact(self, tokens):
+        """ GPT-2 token ids -> compact ids """
+        out = []
+        for t in tokens:
+            if t in self.compact_ids:
+                out.append(self.compact_ids[t])
+            else:
+                out.extend(self.compact_ids[self.enc.encode_single_token(bytes([b]))] for b in self.enc.decode_single_token_bytes(t))
+        return out
+
+    def to_gpt2(self, tokens):
+        """ compact ids -> GPT-2 token ids """
+        return [self.vocab[t] for t in tokens]
+
+def encode_stop_sequences(enc, stops=('</A>', '<|endoftext|>')):
+    """ the stop strings for the stop argument of GPT.generate and friends, see StopSequences """
+    return _stop_sequences(enc, tuple(stops))
+
+@functools.lru_cache(maxsize=16)
+def _stop_sequences(enc, stops):
+    # building one scans the whole vocabulary, so it is done once per encoding
+    return StopSequences(enc, stops)
+
+class StopSequences:
+    """
+    Stop strings matched on the bytes of the generated tokens rather than on their token indices:
+    BPE merges a stop with the text before it ('.</A>' is '.</' 'A' '>', not '</' 'A' '>'), so the
+    tokens of the stop string on its own rarely show up in the output. Only the tokens that can be
+    part of a stop are kept, so the object is small and picklable (for worker_pool.py): a token
+    whose bytes are inside a stop string, or end with the start of one.
+    """
+
+    def __init__(self, enc, stops):
+        self.stops = [s.encode('utf-8') for s in stops]
+        self.max_len = max(len(s) for s in self.stops)
+        prefixes = {s[:i] for s in self.stops for i in range(1, len(s) + 1)}
+        self.token_bytes = {}
+        for t in range(enc.n_vocab):
+            try:
+                b = enc.decode_single_token_bytes(t)
+            except KeyError:
+                continue # unused id
+            if any(b in s for s in self.stops) or any(b.endswith(p) for p in prefixes):
+                self.token_bytes[t] = b
+
+    def matches(self, tokens):
+        """ True if the text of the list of token indices ends with one of the stop strings """
+        tail = b''
+        for t in reversed(tokens):
+            b = self.token_bytes.get(t)
+            if b is None:
+                break # this token and the ones before it are not part of any stop
+            tail = b + tail
+            if len(tail) >= self.max_len:
+                break
+        return any(tail.endswith(s) for s in self.stops)
+
+class IncrementalDetokenizer:
+    """
+    Turns a stream of token indices back into text, one token at a time. GPT-2 BPE tokens are
+    byte sequences that can end in the middle of a multi-byte UTF-8 character, so the bytes go
+    through an incremental UTF-8 decoder that holds back an incomplete character until the rest
+    of it arrives. Joining all pieces (plus flush()) gives the same text as enc.decode(tokens).
+    """
+
+    def __init__(self, enc):
+        self.enc = enc
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def add(self, token):
+        """ feed one token index, return the text that became complete (possibly empty) """
+        return self.decoder.decode(self.enc.decode_single_token_bytes(token))
+
+    def flush(self):
+        """ end of the stream, return whatever is still held back """
+        return self.decoder.decode(b'', final=True)
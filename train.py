@@ -22,12 +22,13 @@ import math
 import pickle
 from contextlib import nullcontext
 
-import numpy as np
 import torch
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.distributed import init_process_group, destroy_process_group
 
 from model import GPTConfig, GPT
+from data_loader import PrefetchLoader, eval_batches
+from checkpoint import CheckpointManager
 
 # -----------------------------------------------------------------------------
 # default config values designed to train a gpt2 (124M) on OpenWebText
@@ -37,7 +38,10 @@ eval_interval = 2000
 log_interval = 1
 eval_iters = 200
 eval_only = False # if True, script exits right after the first eval
+eval_mode = 'sampled' # 'sampled': eval_iters random batches per split, 'full': one deterministic pass over all of val.bin
+eval_train = True # estimate the train loss on eval_iters random batches, else report the running average of the training losses
 always_save_checkpoint = True # if True, always save a checkpoint after each eval
+keep_checkpoints = 3 # besides ckpt.pt (last) and ckpt_best.pt, keep this many recent ones in out_dir/recent
 init_from = 'scratch' # 'scratch' or 'resume' or 'gpt2*'
 # wandb logging
 wandb_log = False # disabled by default
@@ -48,6 +52,8 @@ dataset = 'openwebtext'
 gradient_accumulation_steps = 5 * 8 # used to simulate larger batch sizes
 batch_size = 12 # if gradient_accumulation_steps > 1, this is the micro-batch size
 block_size = 1024
+prefetch_depth = 4 # batches prepared ahead by a background thread, 0 = load them synchronously
+packed = False # fill windows with whole documents (needs the <split>_docs.bin of data prep), attention stays within each document
 # model
 n_layer = 12
 n_head = 12
@@ -111,24 +117,14 @@ device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.aut
 ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
-# poor man's data loader
+# data loader, batches are assembled by a background thread while the model runs
 data_dir = os.path.join('data', dataset)
+loaders = {split: PrefetchLoader(data_dir, split, batch_size, block_size, device, prefetch_depth, seed=1337 + seed_offset + k, packed=packed)
+           for k, split in enumerate(['train', 'val'])}
 def get_batch(split):
-    # We recreate np.memmap every batch to avoid a memory leak, as per
-    # https://stackoverflow.com/questions/45132940/numpy-memmap-memory-usage-want-to-iterate-once/61472122#61472122
-    if split == 'train':
-        data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-    else:
-        data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
-    if device_type == 'cuda':
-        # pin arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-    else:
-        x, y = x.to(device), y.to(device)
-    return x, y
+    return loaders[split].next()
+# eval_mode = 'full': the val windows are cut once and stay in memory, see eval_batches
+val_batches = eval_batches(data_dir, 'val', batch_size, block_size, device, packed) if eval_mode == 'full' else None
 
 # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
 iter_num = 0
@@ -165,17 +161,9 @@ elif init_from == 'resume':
     # the rest of the attributes (e.g. dropout) can stay as desired from command line
     for k in ['n_layer', 'n_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
         model_args[k] = checkpoint_model_args[k]
-    # create the model
+    # create the model on the meta device and materialize it straight from the checkpoint tensors
     gptconf = GPTConfig(**model_args)
-    model = GPT(gptconf)
-    state_dict = checkpoint['model']
-    # fix the keys of the state dictionary :(
-    # honestly no idea how checkpoints sometimes get this prefix, have to debug more
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
+    model = GPT.meta(gptconf).assign_state_dict(checkpoint['model'])
     iter_num = checkpoint['iter_num']
     best_val_loss = checkpoint['best_val_loss']
 elif init_from.startswith('gpt2'):
@@ -216,12 +204,22 @@ if ddp:
 def estimate_loss():
     out = {}
     model.eval()
-    for split in ['train', 'val']:
+    for split in ['train', 'val'] if eval_train else ['val']:
+        if split == 'val' and val_batches is not None:
+            # exact mean over every target of val.bin, batches weighted by their number of targets
+            total, count = 0.0, 0
+            for X, Y, D in val_batches:
+                with ctx:
+                    logits, loss = model(X, Y, doc_ids=D)
+                n = (Y >= 0).sum().item()
+                total, count = total + loss.item() * n, count + n
+            out[split] = total / count
+            continue
         losses = torch.zeros(eval_iters)
         for k in range(eval_iters):
-            X, Y = get_batch(split)
+            X, Y, D = get_batch(split)
             with ctx:
-                logits, loss = model(X, Y)
+                logits, loss = model(X, Y, doc_ids=D)
             losses[k] = loss.item()
         out[split] = losses.mean()
     model.train()
@@ -247,11 +245,13 @@ if wandb_log and master_process:
     wandb.init(project=wandb_project, name=wandb_run_name, config=config)
 
 # training loop
-X, Y = get_batch('train') # fetch the very first batch
+X, Y, D = get_batch('train') # fetch the very first batch
 t0 = time.time()
 local_iter_num = 0 # number of iterations in the lifetime of this process
 raw_model = model.module if ddp else model # unwrap DDP container if needed
 running_mfu = -1.0
+ckpt_manager = CheckpointManager(out_dir, keep_checkpoints) if master_process else None
+train_loss_sum, train_loss_iters = 0.0, 0 # training losses since the last eval, for eval_train = False
 while True:
 
     # determine and set the learning rate for this iteration
@@ -262,6 +262,10 @@ while True:
     # evaluate the loss on train/val sets and write checkpoints
     if iter_num % eval_interval == 0 and master_process:
         losses = estimate_loss()
+        if not eval_train:
+            # mean training loss (in train mode, i.e. with dropout) since the last eval, nan at the first one
+            losses['train'] = float(train_loss_sum) / train_loss_iters if train_loss_iters else float('nan')
+            train_loss_sum, train_loss_iters = 0.0, 0
         print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
         if wandb_log:
             wandb.log({
@@ -271,8 +275,9 @@ while True:
                 "lr": lr,
                 "mfu": running_mfu*100, # convert to percentage
             })
-        if losses['val'] < best_val_loss or always_save_checkpoint:
-            best_val_loss = losses['val']
+        is_best = losses['val'] < best_val_loss
+        if is_best or always_save_checkpoint:
+            best_val_loss = min(best_val_loss, losses['val'])
             if iter_num > 0:
                 checkpoint = {
                     'model': raw_model.state_dict(),
@@ -282,8 +287,12 @@ while True:
                     'best_val_loss': best_val_loss,
                     'config': config,
                 }
-                print(f"saving checkpoint to {out_dir}")
-                torch.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
+                # snapshot to CPU memory, the write and atomic rename happen in the background
+                blocked, write_time = ckpt_manager.save(checkpoint, iter_num, is_best)
+                print(f"saving checkpoint to {out_dir}{' (best)' if is_best else ''}: training blocked {blocked*1000:.1f}ms"
+                      f"{f', previous write took {write_time*1000:.1f}ms' if write_time else ''}")
+                if wandb_log:
+                    wandb.log({"iter": iter_num, "checkpoint/block_ms": blocked*1000})
     if iter_num == 0 and eval_only:
         break
 
@@ -297,10 +306,11 @@ while True:
             # looking at the source of that context manager, it just toggles this variable
             model.require_backward_grad_sync = (micro_step == gradient_accumulation_steps - 1)
         with ctx:
-            logits, loss = model(X, Y)
+            logits, loss = model(X, Y, doc_ids=D)
             loss = loss / gradient_accumulation_steps # scale the loss to account for gradient accumulation
+        train_loss_sum += loss.detach() # no sync, read at the next eval
         # immediately async prefetch next batch while model is doing the forward pass on the GPU
-        X, Y = get_batch('train')
+        X, Y, D = get_batch('train')
         # backward pass, with gradient scaling if training in fp16
         scaler.scale(loss).backward()
     # clip the gradient
@@ -324,13 +334,19 @@ while True:
         if local_iter_num >= 5: # let the training loop settle a bit
             mfu = raw_model.estimate_mfu(batch_size * gradient_accumulation_steps, dt)
             running_mfu = mfu if running_mfu == -1.0 else 0.9*running_mfu + 0.1*mfu
-        print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, mfu {running_mfu*100:.2f}%")
+        # loader stats since the last log: batches ready when the loop asked, time it waited for one
+        load = loaders['train'].stats()
+        print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, mfu {running_mfu*100:.2f}%, "
+              f"loader queue {load['depth']:.1f}/{prefetch_depth}, stall {load['stall']*1000:.2f}ms")
     iter_num += 1
     local_iter_num += 1
+    train_loss_iters += 1
 
     # termination conditions
     if iter_num > max_iters:
         break
 
+if ckpt_manager is not None:
+    ckpt_manager.wait() # publish the last checkpoint before exiting
 if ddp:
     destroy_process_group()
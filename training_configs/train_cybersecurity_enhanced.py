@@ -6,6 +6,8 @@ out_dir = 'out-cybersecurity-enhanced'
 eval_interval = 100  # Evaluate frequently
 log_interval = 5     # Log frequently to track progress
 eval_iters = 30      # More evaluation iterations
+eval_mode = 'full'   # val.bin is small: evaluate it exactly, in one deterministic pass
+eval_train = False   # report the running average of the training losses instead of re-sampling train.bin
 eval_only = False
 always_save_checkpoint = True
 init_from = 'scratch'
@@ -0,0 +1,241 @@
+"""
+Multi-process CPU inference. N worker processes each run an InferenceEngine on their own,
+disjoint set of cores, and all of them read the same weights from shared memory.
+
+A single Python process cannot keep a many-core box busy: the decode loop holds the GIL between
+the small per-token matmuls, and one big intra-op thread pool mostly contends with itself.
+Several processes with a few threads each scale much better. The model's parameters are moved
+to shared memory once (model.share_memory()) and handed to the workers, which map the same
+pages instead of holding a copy, so every extra worker only adds its activations and KV caches.
+
+Every worker has its own request queue and a new request goes to the worker with the fewest
+unfinished requests, so idle workers pick up work first and nobody hoards requests.
+
+Failures stay as local as possible: a request the engine rejects (e.g. a token index outside the
+vocabulary) fails on its own, an error in a batched step fails the requests of that worker, which
+then carries on with a fresh engine, and a worker process that dies takes only its own requests
+with it and is replaced by a new one.
+
+>>> pool = WorkerPool(model, num_workers=4)
+>>> future = pool.submit(Request(prompt=ids, max_new_tokens=150))
+>>> future.result().output
+>>> pool.close()
+
+$ python worker_pool.py --out_dir=out-cybersecurity-enhanced --workers=1,2,4,8 # scaling benchmark
+"""
+
+import os
+import time
+import queue
+import itertools
+import threading
+import traceback
+from concurrent.futures import Future
+
+import torch
+import torch.multiprocessing as mp
+
+from engine import InferenceEngine, Scheduler, Request
+
+def _worker(worker, model, cores, max_batch_size, requests, results):
+    """
+    worker process: pin to cores, then continuously batch the requests of its queue. Sends
+    ('done', pool_id, ...) or ('error', pool_id, traceback) for every request it was given, and
+    ('crashed', worker, traceback) if it dies on an error
+    """
+    try:
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+        new_engine = lambda: InferenceEngine(model, Scheduler(max_batch_size=max_batch_size))
+        engine = new_engine()
+        pool_ids = {} # engine request_id -> pool request_id
+        closing = False
+        while not closing or engine.has_unfinished():
+            # admit new requests while the batch has room, only block when there is nothing to do
+            while not closing and len(engine.running) + len(engine.scheduler.waiting) < max_batch_size:
+                try:
+                    item = requests.get(block=not engine.has_unfinished())
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                pool_id, request = item
+                arrival_time = request.arrival_time
+                try:
+                    pool_ids[engine.add_request(request)] = pool_id
+                except Exception:
+                    results.put(('error', pool_id, traceback.format_exc()))
+                    continue
+                request.arrival_time = arrival_time # time spent in the pool's queues counts as well
+            try:
+                with torch.no_grad():
+                    finished = engine.step()
+            except Exception:
+                # the batch is in an unknown state, fail what this worker holds and start over
+                error = traceback.format_exc()
+                for pool_id in pool_ids.values():
+                    results.put(('error', pool_id, error))
+                pool_ids.clear()
+                engine = new_engine()
+                continue
+            for r in finished:
+                results.put(('done', pool_ids.pop(r.request_id), r.output, r.finish_reason, r.first_token_time, r.finish_time))
+    except Exception:
+        results.put(('crashed', worker, traceback.format_exc()))
+
+class WorkerPool:
+
+    def __init__(self, model, num_workers, cores_per_worker=None, max_batch_size=16):
+        cores = sorted(os.sched_getaffinity(0))
+        cores_per_worker = cores_per_worker or len(cores) // num_workers
+        assert 1 <= cores_per_worker and num_workers * cores_per_worker <= len(cores), \
+            f"{num_workers} workers x {cores_per_worker} cores do not fit on {len(cores)} cores"
+        model.eval()
+        model.share_memory() # the workers map these pages instead of copying the weights
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self._ctx = mp.get_context('spawn')
+        self.results = self._ctx.Queue()
+        self._cores = [cores[i * cores_per_worker:(i + 1) * cores_per_worker] for i in range(num_workers)]
+        self.queues = [None] * num_workers
+        self.workers = [None] * num_workers
+        for i in range(num_workers):
+            self._spawn(i)
+        self._ids = itertools.count()
+        self._pending = {} # pool request_id -> (request, future)
+        self._owner = {} # pool request_id -> index of the worker it was given to
+        self._load = [0] * num_workers # unfinished requests per worker
+        self._closing = False
+        self._lock = threading.Lock()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def submit(self, request):
+        """ queue a request, returns a Future that resolves to the request with its output filled in """
+        future = Future()
+        request.request_id = next(self._ids)
+        request.arrival_time = time.time()
+        with self._lock:
+            # the least busy worker, an idle one if there is any
+            worker = min(range(len(self.workers)), key=self._load.__getitem__)
+            self._pending[request.request_id] = (request, future)
+            self._owner[request.request_id] = worker
+            self._load[worker] += 1
+            self.queues[worker].put((request.request_id, request))
+        return future
+
+    def generate(self, requests):
+        """ convenience: submit all requests and wait until every one of them has finished """
+        futures = [self.submit(r) for r in requests]
+        return [f.result() for f in futures]
+
+    def close(self):
+        """ let the workers finish what they have, then stop them """
+        self._closing = True
+        for q in self.queues:
+            q.put(None)
+        for p in self.workers:
+            p.join()
+        self.results.put(None)
+        self._collector.join()
+
+    def _spawn(self, i):
+        # a fresh queue as well: a worker killed inside get() leaves the lock of its queue held
+        self.queues[i] = self._ctx.Queue()
+        self.workers[i] = self._ctx.Process(target=_worker, args=(i, self.model, self._cores[i], self.max_batch_size,
+                                                                  self.queues[i], self.results), daemon=True)
+        self.workers[i].start()
+
+    def _collect(self):
+        """ thread that hands the workers' results to the waiting futures and replaces dead workers """
+        while True:
+            try:
+                item = self.results.get(timeout=1.0)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                return
+            if item:
+                self._handle(item)
+            for i, p in enumerate(self.workers):
+                if not p.is_alive() and not self._closing:
+                    # what the worker sent before it died comes first, then the rest of its requests fail
+                    while True:
+                        try:
+                            item = self.results.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is None:
+                            return
+                        self._handle(item)
+                    self._fail_worker(i, f"inference worker {i} exited with code {p.exitcode}", respawn=True)
+
+    def _handle(self, item):
+        kind, *item = item
+        if kind == 'crashed':
+            self._fail_worker(*item)
+            return
+        pool_id = item[0]
+        with self._lock:
+            request, future = self._pending.pop(pool_id, (None, None))
+            if future is None:
+                return # already failed along with its worker
+            self._load[self._owner.pop(pool_id)] -= 1
+        if kind == 'error':
+            future.set_exception(RuntimeError(f"request failed in inference worker:\n{item[1]}"))
+            return
+        request.output, request.finish_reason, request.first_token_time, request.finish_time = item[1:]
+        future.set_result(request)
+
+    def _fail_worker(self, worker, error, respawn=False):
+        """ fail the requests given to a dead worker, nothing it held will ever finish, and optionally replace it """
+        with self._lock:
+            pool_ids = [pool_id for pool_id, owner in self._owner.items() if owner == worker]
+            for pool_id in pool_ids:
+                del self._owner[pool_id]
+            self._load[worker] -= len(pool_ids)
+            failed = [self._pending.pop(pool_id)[1] for pool_id in pool_ids]
+            if respawn:
+                # only once its requests are taken out, so whatever submit() sends it from now on is its own
+                self._spawn(worker)
+        for future in failed:
+            future.set_exception(RuntimeError(f"inference worker failed:\n{error}"))
+
+def _memory(pid):
+    """ resident memory of a process in MB, split into private (anonymous) and shared pages (Linux) """
+    with open(f'/proc/{pid}/status') as f:
+        fields = dict(line.split(':', 1) for line in f)
+    return {k: int(fields[k].split()[0]) / 1024 for k in ('RssAnon', 'RssShmem')}
+
+if __name__ == '__main__':
+    from model import GPTConfig, GPT
+    out_dir = 'out'
+    workers = (1, 2, 4) # worker counts to compare, e.g. --workers=1,2,4,8
+    cores_per_worker = 0 # 0 = split all available cores evenly
+    num_requests = 64
+    max_new_tokens = 100
+    max_batch_size = 8 # per worker
+    seed = 1337
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -------------------------------------------------------------------------
+
+    checkpoint = torch.load(os.path.join(out_dir, 'ckpt.pt'), map_location='cpu')
+    model = GPT.meta(GPTConfig(**checkpoint['model_args'])).assign_state_dict(checkpoint['model'])
+    del checkpoint
+    weights_mb = sum(p.numel() * p.element_size() for p in model.parameters()) / 1e6
+
+    g = torch.Generator().manual_seed(seed)
+    prompts = [torch.randint(model.config.vocab_size, (16,), generator=g).tolist() for _ in range(num_requests)]
+    print(f"{weights_mb:.1f} MB of weights, {num_requests} requests x {max_new_tokens} tokens")
+    for n in workers:
+        pool = WorkerPool(model, n, cores_per_worker or None, max_batch_size)
+        pool.generate([Request(prompts[0], 1)]) # warmup: wait until the workers are up
+        t0 = time.time()
+        done = pool.generate([Request(p, max_new_tokens, seed=i) for i, p in enumerate(prompts)])
+        dt = time.time() - t0
+        mem = [_memory(p.pid) for p in pool.workers]
+        pool.close()
+        tokens = sum(len(r.output) for r in done)
+        print(f"{n} workers: {tokens/dt:8.1f} tokens/s, per worker RSS private "
+              f"{max(m['RssAnon'] for m in mem):.1f} MB, shared {max(m['RssShmem'] for m in mem):.1f} MB")